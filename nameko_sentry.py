@@ -1,13 +1,56 @@
+import argparse
+import fnmatch
+import gc
+import hashlib
+import json
 import logging
+import mmap
+import os
+import random
 import re
+import struct
+import sys
+import time
+import uuid
+import zlib
+from collections import Counter, defaultdict, deque, OrderedDict
+from contextlib import contextmanager
+from email.utils import mktime_tz, parsedate_tz
+from functools import partial, wraps
 
+import eventlet
+from eventlet import tpool, wsgi
+from eventlet.corolocal import local
+from eventlet.greenpool import GreenPool
+from eventlet.hubs import get_hub
+from eventlet.semaphore import Semaphore
+from nameko.exceptions import RemoteError
 from nameko.extensions import DependencyProvider
-from nameko.web.handlers import HttpRequestHandler
 from raven import Client
-from raven.utils.wsgi import get_environ, get_headers
+from raven.base import SDK_VALUE
+from raven.breadcrumbs import make_buffer
+from raven.context import Context
+from raven.transport.http import HTTPTransport
+from raven.events import Exception as ExceptionEvent
+from raven.utils import merge_dicts
+from raven.utils.imports import import_string
+from raven.utils.wsgi import get_headers
 from raven.transport.eventlet import EventletHTTPTransport
+import six
 from six.moves.urllib.parse import urlsplit  # pylint: disable=E0401
-from werkzeug.exceptions import ClientDisconnected
+import wrapt
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover (windows)
+    fcntl = None
+
+try:
+    import tracemalloc
+except ImportError:  # pragma: no cover (python 2)
+    tracemalloc = None
+
+log = logging.getLogger(__name__)
 
 USER_TYPE_CONTEXT_KEYS = (
     re.compile("user|email|session"),
@@ -15,12 +58,1771 @@ USER_TYPE_CONTEXT_KEYS = (
 TAG_TYPE_CONTEXT_KEYS = (
     re.compile("call_id$"),
 )
+HTTP_ENVIRON = (
+    'REMOTE_ADDR',
+    'SERVER_NAME',
+    'SERVER_PORT',
+)
+
+# cap on the caches of memoized context key match results
+MATCH_CACHE_SIZE = 1024
+
+# cap on the cache of per-code object fingerprint contributions
+FRAME_CACHE_SIZE = 1024
+
+timer = getattr(time, 'perf_counter', time.time)
+
+# number of per-event measurements kept in `MEMORY_DEBUG` mode
+MEMORY_STATS_SIZE = 100
+
+SCRUB_KEYS = (
+    'password',
+    'secret',
+    'passwd',
+    'authorization',
+    'api_key',
+    'apikey',
+    'sentry_dsn',
+    'access_token',
+    'cookie',
+)
+# whole values shaped like an authorization header, so that prose
+# mentioning "bearer" or "basic" is left alone
+SCRUB_VALUE_PATTERNS = (
+    r'^\s*(?:[Bb]earer|[Bb]asic)\s+[\w.~+/=-]{8,}\s*$',
+)
+SCRUB_MASK = '*' * 8
+CARD_PATTERN = re.compile(r'\b(?:\d[ -]?){12,18}\d\b')
+# issuer prefixes and lengths of the major card schemes: visa,
+# mastercard, american express, diners club, discover and jcb
+CARD_NUMBER_PATTERN = re.compile(
+    r'(?:4\d{12}(?:\d{3}){0,2}'
+    r'|(?:5[1-5]\d\d|222[1-9]|22[3-9]\d|2[3-6]\d\d|27[01]\d|2720)\d{12}'
+    r'|3[47]\d{13}'
+    r'|3(?:0[0-5]|[689]\d)\d{11}'
+    r'|(?:6011|65\d\d|64[4-9]\d)\d{12}(?:\d{3})?'
+    r'|35(?:2[89]|[3-8]\d)\d{12,15})$'
+)
+
+
+def luhn_valid(digits):
+    """ Return True if `digits` pass the Luhn checksum used by card numbers.
+    """
+    total = 0
+    for index, digit in enumerate(reversed(digits)):
+        value = int(digit)
+        if index % 2:
+            value *= 2
+            if value > 9:
+                value -= 9
+        total += value
+    return total % 10 == 0
+
+
+class Scrubber(object):
+    """ Mask sensitive data as context is being built.
+
+    Values under keys containing any of `keys` (compared case-insensitively,
+    with dashes treated as underscores) are replaced entirely. Substrings of
+    other string values matching any of `value_patterns`, and card numbers
+    if `mask_cards` is set, are masked in place. Card numbers must have the
+    prefix and length of a major card scheme and pass the Luhn check, so
+    that other long numbers such as timestamps and ids are left alone.
+
+    The decision for each key is memoized, so the usual small, repetitive
+    set of header and context keys costs one dict lookup per item.
+    """
+
+    def __init__(
+        self, keys=SCRUB_KEYS, value_patterns=SCRUB_VALUE_PATTERNS,
+        mask_cards=True, mask=SCRUB_MASK
+    ):
+        self.key_pattern = None
+        if keys:
+            self.key_pattern = re.compile('|'.join(
+                re.escape(key.lower().replace('-', '_')) for key in keys
+            ))
+        self.value_pattern = None
+        if value_patterns:
+            self.value_pattern = re.compile('|'.join(
+                '(?:{})'.format(pattern) for pattern in value_patterns
+            ))
+        self.mask_cards = mask_cards
+        self.mask = mask
+        self.decisions = {}
+
+    def is_sensitive(self, key):
+        try:
+            return self.decisions[key]
+        except KeyError:
+            pass
+        normalized = key
+        if isinstance(normalized, six.binary_type):
+            normalized = normalized.decode('utf-8', 'replace')
+        normalized = six.text_type(normalized).lower().replace('-', '_')
+        sensitive = bool(
+            self.key_pattern and self.key_pattern.search(normalized)
+        )
+        if len(self.decisions) >= MATCH_CACHE_SIZE:
+            self.decisions.clear()
+        self.decisions[key] = sensitive
+        return sensitive
+
+    def mask_card(self, match):
+        digits = re.sub(r'\D', '', match.group())
+        if CARD_NUMBER_PATTERN.match(digits) and luhn_valid(digits):
+            return self.mask
+        return match.group()
+
+    def scrub_value(self, value):
+        """ Mask sensitive substrings of `value`, descending into
+        containers.
+        """
+        if isinstance(value, six.string_types):
+            if self.value_pattern is not None:
+                value = self.value_pattern.sub(self.mask, value)
+            if self.mask_cards:
+                value = CARD_PATTERN.sub(self.mask_card, value)
+            return value
+        if isinstance(value, dict):
+            return self.scrub_items(six.iteritems(value))
+        if isinstance(value, (list, tuple)):
+            return type(value)(self.scrub_value(item) for item in value)
+        return value
+
+    def scrub(self, key, value):
+        if self.is_sensitive(key):
+            return self.mask
+        return self.scrub_value(value)
+
+    def scrub_items(self, items):
+        """ Return a dict of the scrubbed `(key, value)` pairs in `items`.
+        """
+        return {key: self.scrub(key, value) for key, value in items}
+
+    def scrub_query(self, query_string):
+        """ Scrub the values of an urlencoded query string.
+        """
+        if not query_string:
+            return query_string
+        pairs = []
+        for pair in query_string.split('&'):
+            key, sep, value = pair.partition('=')
+            if sep:
+                value = self.scrub(key, value)
+            pairs.append(key + sep + value)
+        return '&'.join(pairs)
+
+    def scrub_body(self, data):
+        """ Scrub a raw (JSON) request body.
+
+        Bodies that decode as JSON are returned as the scrubbed structure.
+        """
+        if isinstance(data, six.binary_type):
+            data = data.decode('utf-8', 'replace')
+        try:
+            return self.scrub_value(json.loads(data))
+        except ValueError:
+            return self.scrub_value(data)
+
+
+def load_scrubber(config):
+    """ Build a `Scrubber` from the `SCRUB` config, or return None if
+    scrubbing is not enabled.
+    """
+    if not config:
+        return None
+    if config is True:
+        config = {}
+    return Scrubber(
+        keys=config.get('KEYS', SCRUB_KEYS),
+        value_patterns=config.get('VALUE_PATTERNS', SCRUB_VALUE_PATTERNS),
+        mask_cards=config.get('MASK_CARDS', True),
+        mask=config.get('MASK', SCRUB_MASK),
+    )
+
+
+def hash_fingerprint(parts):
+    """ Return the hex digest identifying an event fingerprinted by the
+    strings `parts`, as shared by dedup.
+    """
+    return hashlib.sha1('\n'.join(parts).encode('utf-8')).hexdigest()
+
+
+class Fingerprinter(object):
+    """ Compute a stable fingerprint for an exception from its type and the
+    in-app frames of its traceback.
+
+    Frames are normalised to `<module>.<function>`, so the fingerprint
+    doesn't change with line numbers or install paths. If `include_paths`
+    is given, only frames of modules under those paths (and not under
+    `exclude_paths`) are in-app, as with raven's client options; otherwise
+    all frames are.
+
+    Each code object's contribution is cached, so fingerprinting a
+    repeated stack is a dictionary lookup per frame.
+    """
+    def __init__(self, include_paths=(), exclude_paths=()):
+        self.include_paths = tuple(include_paths)
+        self.exclude_paths = tuple(exclude_paths)
+        self.frames = {}
+
+    def is_in_app(self, module):
+        if not self.include_paths:
+            return True
+        return (
+            module.startswith(self.include_paths) and
+            not module.startswith(self.exclude_paths)
+        )
+
+    def frame_key(self, frame):
+        """ Return the contribution of `frame` to a fingerprint, or None if
+        it isn't in-app.
+        """
+        code = frame.f_code
+        try:
+            return self.frames[code]
+        except KeyError:
+            pass
+        module = frame.f_globals.get('__name__') or ''
+        key = None
+        if self.is_in_app(module):
+            key = '{}.{}'.format(module, code.co_name)
+        if len(self.frames) >= FRAME_CACHE_SIZE:
+            self.frames.clear()
+        self.frames[code] = key
+        return key
+
+    def fingerprint(self, exc_info):
+        exc_type, _, tb = exc_info
+        parts = ['{}.{}'.format(exc_type.__module__, exc_type.__name__)]
+        while tb is not None:
+            key = self.frame_key(tb.tb_frame)
+            if key is not None:
+                parts.append(key)
+            tb = tb.tb_next
+        return hash_fingerprint(parts)
+
+
+# default location of the host-wide deduplication table
+DEDUP_PATH = '/dev/shm/nameko_sentry_dedup'
+
+DEDUP_MAGIC = b'NSDD'
+DEDUP_VERSION = 1
+
+# magic, version, number of slots
+DEDUP_HEADER = struct.Struct('<4sHxxI')
+# fingerprint key, last reported time, number suppressed since
+DEDUP_SLOT = struct.Struct('<QdQ')
+
+# slots probed for a fingerprint before giving up on the table
+DEDUP_PROBES = 16
+
+
+class SharedDedup(object):
+    """ Host-wide table of recently reported fingerprints, shared by every
+    process that maps the file at `path` (by default in `/dev/shm`).
+
+    The table is a fixed-size open-addressing hash of `slots` entries,
+    each a fingerprint key, the time it was last reported and the number
+    of duplicates suppressed since. A fingerprint is reported by only one
+    process per `window` seconds. Lookups and updates take a short
+    exclusive `fcntl` lock on the file, as Python has no atomic operations
+    on shared memory.
+
+    The file is created and initialised by the first process; opening a
+    table with a different layout raises ValueError. If the header is
+    found to be corrupt later, or a fingerprint can't be placed, `check`
+    lets the event through, so a damaged table only costs deduplication.
+    If the file is resized by another process, touching the map could
+    crash this one, so the table is disabled and lets every event
+    through.
+    """
+    disabled = False
+
+    def __init__(self, path=DEDUP_PATH, slots=4096, window=60):
+        if fcntl is None:  # pragma: no cover (windows)
+            raise ValueError("Shared deduplication requires fcntl")
+        self.path = path
+        self.slots = int(slots)
+        self.window = float(window)
+        self.size = DEDUP_HEADER.size + self.slots * DEDUP_SLOT.size
+        self.header = DEDUP_HEADER.pack(
+            DEDUP_MAGIC, DEDUP_VERSION, self.slots
+        )
+
+        self.fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            with self.locked():
+                if os.fstat(self.fd).st_size == 0:
+                    os.ftruncate(self.fd, self.size)
+                    os.write(self.fd, self.header)
+                if os.fstat(self.fd).st_size != self.size:
+                    raise ValueError(
+                        "Deduplication table {} has a different size".format(
+                            path
+                        )
+                    )
+                self.map = mmap.mmap(self.fd, self.size)
+                if not self.is_valid():
+                    self.map.close()
+                    raise ValueError(
+                        "Deduplication table {} has a different layout".format(
+                            path
+                        )
+                    )
+        except Exception:
+            os.close(self.fd)
+            raise
+
+    @contextmanager
+    def locked(self):
+        fcntl.lockf(self.fd, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.lockf(self.fd, fcntl.LOCK_UN)
+
+    def is_valid(self):
+        return self.map[:DEDUP_HEADER.size] == self.header
+
+    def check(self, fingerprint, now=None):
+        """ Record an occurrence of `fingerprint`.
+
+        Returns None if it was reported within the window, so this
+        occurrence should be skipped, or else the number of occurrences
+        suppressed since it was last reported.
+        """
+        if self.disabled:
+            return 0
+        now = time.time() if now is None else now
+        key = int(fingerprint[:16], 16) or 1
+        with self.locked():
+            if os.fstat(self.fd).st_size != self.size:
+                log.warning(
+                    "Sentry reporter deduplication disabled: "
+                    "table %s has been resized", self.path
+                )
+                self.disabled = True
+                return 0
+            if not self.is_valid():
+                return 0
+            start = key % self.slots
+            free = None
+            for probe in range(min(DEDUP_PROBES, self.slots)):
+                offset = DEDUP_HEADER.size + (
+                    (start + probe) % self.slots
+                ) * DEDUP_SLOT.size
+                slot_key, sent, suppressed = DEDUP_SLOT.unpack_from(
+                    self.map, offset
+                )
+                if slot_key == key:
+                    if now - sent < self.window:
+                        DEDUP_SLOT.pack_into(
+                            self.map, offset, key, sent, suppressed + 1
+                        )
+                        return None
+                    DEDUP_SLOT.pack_into(self.map, offset, key, now, 0)
+                    return suppressed
+                if free is None and (
+                    slot_key == 0 or now - sent >= self.window
+                ):
+                    free = offset
+                if slot_key == 0:
+                    break  # slots are never emptied, so the key isn't further
+            if free is not None:
+                DEDUP_SLOT.pack_into(self.map, free, key, now, 0)
+            return 0
+
+    def close(self):
+        self.map.close()
+        os.close(self.fd)
+
+
+class ContextStage(object):
+    """ A stage of the context extraction pipeline.
+
+    Stages declare the payload fields they touch in `fields`. The pipeline
+    makes a single pass over the worker's context data, calling
+    `process_item` for each item on every stage that overrides it, then
+    calls `process` on each stage in order. Stages may disable themselves
+    during `setup` by clearing `enabled`.
+    """
+    fields = ()
+    enabled = True
+
+    def setup(self, reporter):
+        self.reporter = reporter
+
+    def process_item(self, key, value, payload):
+        """ Handle a single item of the worker's context data.
+
+        Returns the value to pass to later stages.
+        """
+        return value
+
+    def process(self, worker_ctx, exc_info, payload):
+        """ Update `payload` once per event, after the context data pass.
+        """
+
+
+class KeyMatchingStage(ContextStage):
+    """ Base for stages that collect context data items whose keys match
+    any of a list of patterns.
+    """
+    field = None
+
+    def setup(self, reporter):
+        super(KeyMatchingStage, self).setup(reporter)
+        self.matchers = self.get_matchers(reporter)
+        self.matches = {}
+
+    def get_matchers(self, reporter):
+        raise NotImplementedError()  # pragma: no cover
+
+    def is_match(self, key):
+        try:
+            return self.matches[key]
+        except KeyError:
+            pass
+        match = any(re.search(matcher, key) for matcher in self.matchers)
+        if len(self.matches) >= MATCH_CACHE_SIZE:
+            self.matches.clear()
+        self.matches[key] = match
+        return match
+
+    def process_item(self, key, value, payload):
+        if self.is_match(key):
+            payload[self.field][key] = value
+        return value
+
+
+class ScrubStage(ContextStage):
+    """ Scrub worker context data items with the reporter's `Scrubber`
+    before later stages collect them.
+
+    Disabled unless `SCRUB` is configured.
+    """
+    fields = ('user', 'tags', 'extra')
+
+    def setup(self, reporter):
+        super(ScrubStage, self).setup(reporter)
+        self.scrubber = reporter.scrubber
+        self.enabled = self.scrubber is not None
+
+    def process_item(self, key, value, payload):
+        return self.scrubber.scrub(key, value)
+
+
+class UserContextStage(KeyMatchingStage):
+    """ Collect user identifiers from the worker context data.
+    """
+    field = 'user'
+    fields = ('user',)
+
+    def get_matchers(self, reporter):
+        return reporter.user_type_context_keys
+
+
+class TagContextStage(KeyMatchingStage):
+    """ Tag the event with the worker's call ids and entrypoint, plus any
+    context data items with tag-type keys.
+    """
+    field = 'tags'
+    fields = ('tags',)
+
+    def get_matchers(self, reporter):
+        return reporter.tag_type_context_keys
+
+    def process(self, worker_ctx, exc_info, payload):
+        payload['tags'].update({
+            'call_id': worker_ctx.call_id,
+            'parent_call_id': worker_ctx.immediate_parent_call_id,
+            'root_call_id': self.reporter.root_call_id(worker_ctx),
+            'service_name': worker_ctx.container.service_name,
+            'method_name': worker_ctx.entrypoint.method_name
+        })
+
+
+class ExtraContextStage(ContextStage):
+    """ Include all available worker context data as extra context.
+    """
+    fields = ('extra',)
+
+    def process_item(self, key, value, payload):
+        payload['extra'][key] = value
+        return value
+
+
+def header_environ_key(name):
+    """ Return the WSGI environ key for the HTTP header `name`.
+    """
+    key = name.upper().replace('-', '_')
+    if key in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+        return key
+    return 'HTTP_' + key
+
+
+class HttpContextStage(ContextStage):
+    """ Attempt to extract HTTP context if an HTTP entrypoint was used.
+
+    Only the headers and environ keys allowed by the reporter's
+    `HTTP_HEADERS` and `HTTP_ENVIRON` config are captured, looked up
+    directly rather than by scanning the whole environ. All headers are
+    captured if `HTTP_HEADERS` is None.
+
+    Disabled if `nameko.web` hasn't been imported, in which case there can
+    be no HTTP entrypoints; this avoids importing werkzeug otherwise.
+    """
+    fields = ('request',)
+
+    def setup(self, reporter):
+        super(HttpContextStage, self).setup(reporter)
+
+        handlers = sys.modules.get('nameko.web.handlers')
+        self.enabled = handlers is not None
+        if not self.enabled:
+            return
+
+        from werkzeug.exceptions import ClientDisconnected
+        self.entrypoint_cls = handlers.HttpRequestHandler
+        self.disconnected_exc = ClientDisconnected
+
+        self.header_keys = None
+        if reporter.http_headers is not None:
+            environ_keys = frozenset(
+                header_environ_key(name) for name in reporter.http_headers
+            )
+            self.header_keys = tuple(
+                (key, key.replace('HTTP_', '', 1).replace('_', '-').title())
+                for key in sorted(environ_keys)
+            )
+        self.environ_keys = tuple(sorted(frozenset(reporter.http_environ)))
+
+    def iter_headers(self, environ):
+        if self.header_keys is None:
+            return get_headers(environ)
+        return (
+            (name, environ[key])
+            for key, name in self.header_keys if key in environ
+        )
+
+    def iter_environ(self, environ):
+        return (
+            (key, environ[key]) for key in self.environ_keys if key in environ
+        )
+
+    def process(self, worker_ctx, exc_info, payload):
+        if not isinstance(worker_ctx.entrypoint, self.entrypoint_cls):
+            return
+        try:
+            request = worker_ctx.args[0]
+            try:
+                if request.mimetype == 'application/json':
+                    data = request.data
+                else:
+                    data = request.form
+            except self.disconnected_exc:
+                data = {}
+
+            urlparts = urlsplit(request.url)
+            query_string = urlparts.query
+            headers = self.iter_headers(request.environ)
+            env = self.iter_environ(request.environ)
+
+            scrubber = self.reporter.scrubber
+            if scrubber is None:
+                headers = dict(headers)
+                env = dict(env)
+            else:
+                query_string = scrubber.scrub_query(query_string)
+                headers = scrubber.scrub_items(headers)
+                env = scrubber.scrub_items(env)
+                if hasattr(data, 'items'):
+                    data = scrubber.scrub_items(data.items())
+                else:
+                    data = scrubber.scrub_body(data)
+
+            payload['request'].update({
+                'url': '{}://{}{}'.format(
+                    urlparts.scheme, urlparts.netloc, urlparts.path
+                ),
+                'query_string': query_string,
+                'method': request.method,
+                'data': data,
+                'headers': headers,
+                'env': env,
+            })
+        except:
+            pass  # probably not a compatible entrypoint
+
+
+class TruncateStage(ContextStage):
+    """ Truncate long string values in the worker context data.
+
+    Place it before the stages that collect context data items.
+    """
+    fields = ('user', 'tags', 'extra')
+
+    def __init__(self, max_length=200):
+        self.max_length = max_length
+
+    def process_item(self, key, value, payload):
+        if isinstance(value, six.string_types) and (
+            len(value) > self.max_length
+        ):
+            return value[:self.max_length] + '...'
+        return value
+
+
+class SaturationStage(ContextStage):
+    """ Record how loaded the container was when the worker failed.
+
+    Tags the event `saturated` if every worker was busy, and adds the
+    reporter's counts of workers in flight for the container and the
+    entrypoint, `max_workers` and the number of eventlet hub timers and
+    listeners to the extra context.
+    """
+    fields = ('tags', 'extra')
+
+    def process(self, worker_ctx, exc_info, payload):
+        reporter = self.reporter
+        max_workers = reporter.container.max_workers
+        hub = get_hub()
+
+        payload['tags']['saturated'] = (
+            'true' if reporter.active_workers >= max_workers else 'false'
+        )
+        payload['extra'].update({
+            'active_workers': reporter.active_workers,
+            'max_workers': max_workers,
+            'entrypoint_workers': reporter.in_flight[worker_ctx.entrypoint],
+            'hub_timers': len(hub.timers) + len(hub.next_timers),
+            'hub_listeners': sum(
+                len(listeners) for listeners in hub.listeners.values()
+            ),
+        })
+
+
+CONTEXT_PIPELINE = (
+    ScrubStage,
+    UserContextStage,
+    TagContextStage,
+    ExtraContextStage,
+    HttpContextStage,
+    SaturationStage,
+)
+
+
+def load_stage(spec):
+    """ Instantiate a pipeline stage from its `CONTEXT_PIPELINE` entry.
+
+    Entries may be a stage class or dotted path, or a mapping with the
+    class under `STAGE` and any constructor arguments under `OPTIONS`.
+    """
+    options = {}
+    if isinstance(spec, dict):
+        options = spec.get('OPTIONS', {})
+        spec = spec['STAGE']
+    if isinstance(spec, six.string_types):
+        spec = import_string(spec)
+    return spec(**options)
+
+
+class ContextPipeline(object):
+    """ Ordered context extraction stages, fused into one pass over the
+    worker's context data.
+
+    If `timed`, the time spent in each stage is accumulated in `timings`.
+    """
+
+    def __init__(self, stages, timed=False):
+        self.stages = stages
+        self.timed = timed
+        self.timings = {
+            type(stage).__name__: [0, 0.0]
+            for stage in stages if stage.enabled
+        }
+        self.plans = {}
+
+    def plan(self, fields):
+        """ Return the stages that write any of `fields` (all stages if
+        `fields` is None), split into item and per-event stages.
+        """
+        try:
+            return self.plans[fields]
+        except KeyError:
+            pass
+        stages = [
+            stage for stage in self.stages
+            if stage.enabled and (fields is None or set(stage.fields) & fields)
+        ]
+        item_stages = [
+            stage for stage in stages
+            if type(stage).process_item is not ContextStage.process_item
+        ]
+        plan = self.plans[fields] = (stages, item_stages)
+        return plan
+
+    def run(self, worker_ctx, exc_info, fields=None):
+        """ Return the context payload of `worker_ctx`.
+
+        If given, the payload is limited to `fields`, even if the stages
+        that write them also write others.
+        """
+        stages, item_stages = self.plan(fields)
+
+        payload = {}
+        for stage in stages:
+            for field in stage.fields:
+                payload.setdefault(field, {})
+
+        if self.timed:
+            self.run_timed(worker_ctx, exc_info, payload, stages, item_stages)
+        else:
+            if item_stages:
+                for key, value in six.iteritems(worker_ctx.context_data):
+                    for stage in item_stages:
+                        value = stage.process_item(key, value, payload)
+            for stage in stages:
+                stage.process(worker_ctx, exc_info, payload)
+
+        if fields is not None:
+            payload = {
+                field: value for field, value in six.iteritems(payload)
+                if field in fields
+            }
+        return payload
+
+    def run_timed(self, worker_ctx, exc_info, payload, stages, item_stages):
+        elapsed = {type(stage).__name__: 0.0 for stage in stages}
+
+        if item_stages:
+            for key, value in six.iteritems(worker_ctx.context_data):
+                for stage in item_stages:
+                    start = timer()
+                    value = stage.process_item(key, value, payload)
+                    elapsed[type(stage).__name__] += timer() - start
+        for stage in stages:
+            start = timer()
+            stage.process(worker_ctx, exc_info, payload)
+            elapsed[type(stage).__name__] += timer() - start
+
+        for name, seconds in six.iteritems(elapsed):
+            timing = self.timings[name]
+            timing[0] += 1
+            timing[1] += seconds
+
+    def get_timings(self):
+        """ Return the number of runs and total and mean seconds per stage.
+        """
+        return {
+            name: {
+                'calls': calls,
+                'total': total,
+                'mean': total / calls if calls else 0.0,
+            }
+            for name, (calls, total) in six.iteritems(self.timings)
+        }
+
+
+class DetachedExceptionEvent(ExceptionEvent):
+    """ Raven event handler for exceptions already snapshotted with
+    `SentryReporter.snapshot_exception`.
+
+    The `exception` interface is passed in the event data, so there is
+    nothing left to capture from a traceback.
+    """
+
+    def capture(self, **kwargs):
+        return {}
+
+
+# priority lanes of `QueuedEventletHTTPTransport`, highest priority first
+LANES = (
+    ('error', {'weight': 3, 'drop': 'newest'}),
+    ('warning', {'weight': 1, 'drop': 'oldest'}),
+    ('transaction', {'weight': 1, 'drop': 'newest'}),
+)
+DROP_NEWEST = 'newest'
+DROP_OLDEST = 'oldest'
+
+
+def get_lane(level):
+    """ Return the transport lane for events of logging level `level`.
+    """
+    return 'error' if level >= logging.ERROR else 'warning'
+
+
+class Lane(object):
+    """ A bounded queue of payloads with a weight and a drop policy.
+
+    When the queue is full, a `drop` policy of "newest" rejects incoming
+    payloads and "oldest" discards the longest-queued one instead.
+    """
+    def __init__(self, name, weight=1, queue_size=1000, drop=DROP_NEWEST):
+        if drop not in (DROP_NEWEST, DROP_OLDEST):
+            raise ValueError("Unknown drop policy: {}".format(drop))
+        self.name = name
+        self.weight = int(weight)
+        self.queue_size = int(queue_size)
+        self.drop = drop
+        self.queue = deque()
+        self.dropped = 0
+
+    def put(self, payload):
+        """ Queue `payload`, returning the payload dropped to make room for
+        it, if any.
+        """
+        if len(self.queue) >= self.queue_size:
+            self.dropped += 1
+            if self.drop == DROP_NEWEST or not self.queue:
+                return payload
+            dropped = self.queue.popleft()
+            self.queue.append(payload)
+            return dropped
+        self.queue.append(payload)
+        return None
+
+
+# seconds to back off for after a 429 response without a valid Retry-After
+DEFAULT_RETRY_AFTER = 60
+
+# rate limit categories of events
+ERROR_CATEGORY = 'error'
+DEFAULT_CATEGORY = 'default'
+TRANSACTION_CATEGORY = 'transaction'
+
+
+def parse_retry_after(value):
+    """ Return the number of seconds to wait given a `Retry-After` header
+    value, in seconds or as an HTTP date.
+    """
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        pass
+    date = parsedate_tz(value) if value else None
+    if date is None:
+        return DEFAULT_RETRY_AFTER
+    return max(0, mktime_tz(date) - time.time())
+
+
+class RateLimits(object):
+    """ Categories of events a sentry server has asked not to be sent
+    for a while, and until when.
+
+    Updated from the `X-Sentry-Rate-Limits` header of rejected requests,
+    or their `Retry-After` header if the status is 429. A category of None
+    blocks events of all categories.
+    """
+
+    def __init__(self):
+        self.blocked_until = {}
+
+    def block(self, category, seconds):
+        until = timer() + seconds
+        if until > self.blocked_until.get(category, 0):
+            self.blocked_until[category] = until
+
+    def update(self, status, headers):
+        limits = headers.get('X-Sentry-Rate-Limits')
+        if limits:
+            for limit in limits.split(','):
+                parts = limit.strip().split(':')
+                try:
+                    seconds = float(parts[0])
+                except ValueError:
+                    continue
+                categories = parts[1].split(';') if len(parts) > 1 else ()
+                categories = [name for name in categories if name]
+                for category in categories or [None]:
+                    self.block(category, seconds)
+        elif status == 429:
+            self.block(None, parse_retry_after(headers.get('Retry-After')))
+
+    def is_blocked(self, category):
+        if not self.blocked_until:
+            return False
+        now = timer()
+        return (
+            self.blocked_until.get(category, 0) > now or
+            self.blocked_until.get(None, 0) > now
+        )
+
+
+class Payload(tuple):
+    """ An encoded event queued by the transport, as `(url, data, headers)`,
+    with the rate limit `category` it is sent in.
+    """
+
+    def __new__(cls, url, data, headers, category=None):
+        payload = super(Payload, cls).__new__(cls, (url, data, headers))
+        payload.category = category
+        return payload
+
+
+def get_category(data):
+    """ Return the rate limit category of an event built from `data`.
+    """
+    return ERROR_CATEGORY if 'exception' in data else DEFAULT_CATEGORY
+
+
+def is_transient(result):
+    """ Return True if `result`, as returned by `_send_payload`, is a
+    failure worth retrying: a connection error, timeout or server error.
+    """
+    if not isinstance(result, Exception):
+        return False
+    code = getattr(result, 'code', None)
+    return not isinstance(code, int) or code >= 500
+
+
+class RetryBudget(object):
+    """ Token bucket capping retries to a fraction of sends.
+
+    Each send deposits `ratio` tokens, up to `burst`, and each retry takes
+    one, so once the initial `burst` is spent at most `ratio` retries are
+    made per send. Shared by the transports of a container.
+    """
+
+    def __init__(self, ratio=0.1, burst=10):
+        self.ratio = float(ratio)
+        self.burst = float(burst)
+        self.tokens = self.burst
+        self.exhausted = 0
+
+    def deposit(self):
+        self.tokens = min(self.burst, self.tokens + self.ratio)
+
+    def withdraw(self):
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        self.exhausted += 1
+        return False
+
+
+class QueuedEventletHTTPTransport(EventletHTTPTransport):
+    """ Eventlet HTTP transport that sends events from bounded queues,
+    using up to `pool_size` concurrent sender greenlets.
+
+    Events are queued in priority lanes (see `LANES`), chosen for each
+    event with `use_lane`. Senders take from the lanes in weighted round
+    robin, so a flood of events in one lane can neither starve nor push
+    out events in another. `lanes` overrides the weight, `queue_size` and
+    drop policy of each lane.
+
+    Outstanding events can be flushed with a deadline using `drain`, or
+    abandoned immediately with `kill`; both return the payloads that were
+    not sent.
+
+    Rate limits in rejected responses are recorded in `rate_limits`, so
+    that events can be skipped before they're built; see
+    `SentryReporter.is_rate_limited`. Queued events whose category (see
+    `use_lane`) is blocked are dropped rather than sent or retried, and
+    counted in `blocked`.
+
+    Sends that fail transiently are retried up to `retries` times by the
+    same sender, after an exponential backoff from `retry_backoff` to at
+    most `retry_backoff_max` seconds, with full jitter. Retries are also
+    limited by `retry_budget`. A retried event is held as the encoded
+    payload only.
+
+    If given, `spill` is called with a list of payloads that are lost
+    while the transport is running: those dropped from a full lane, and
+    those that still fail transiently (or are rate limited) once retries
+    are given up.
+    """
+
+    def __init__(
+        self, pool_size=10, queue_size=1000, lanes=None, retries=0,
+        retry_backoff=0.5, retry_backoff_max=30, retry_budget=None,
+        spill=None, **kwargs
+    ):
+        super(QueuedEventletHTTPTransport, self).__init__(**kwargs)
+        lanes = lanes or {}
+        self.lanes = OrderedDict()
+        for name, options in LANES:
+            options = dict(options, queue_size=queue_size)
+            options.update(lanes.get(name, {}))
+            self.lanes[name] = Lane(name, **options)
+        self.default_lane = LANES[0][0]
+        self.schedule = [
+            lane for lane in self.lanes.values()
+            for _ in range(lane.weight)
+        ]
+        self.position = 0
+        self.current = local()
+        self.in_flight = {}
+        self.pool = GreenPool(int(pool_size))
+        self.accepting = True
+        self.sent = 0
+        self.rejected = 0
+        self.rate_limits = RateLimits()
+        self.retries = int(retries)
+        self.retry_backoff = float(retry_backoff)
+        self.retry_backoff_max = float(retry_backoff_max)
+        self.retry_budget = retry_budget or RetryBudget()
+        self.retried = 0
+        self.spill = spill
+        self.blocked = 0
+
+    @property
+    def dropped(self):
+        return self.rejected + self.blocked + sum(
+            lane.dropped for lane in self.lanes.values()
+        )
+
+    @contextmanager
+    def use_lane(self, name, category=None):
+        """ Queue events sent by the current greenlet in lane `name`,
+        as events of rate limit `category`.
+        """
+        self.current.lane = name
+        self.current.category = category
+        try:
+            yield
+        finally:
+            del self.current.lane
+            del self.current.category
+
+    def send(self, url, data, headers):
+        if not self.accepting:
+            self.rejected += 1
+            return
+        lane = self.lanes[getattr(self.current, 'lane', self.default_lane)]
+        dropped = lane.put(Payload(
+            url, data, headers, getattr(self.current, 'category', None)
+        ))
+        if dropped is not None and self.spill is not None:
+            self.spill([dropped])
+        if self.pool.free():
+            self.pool.spawn(self.run_sender)
+
+    def next_payload(self):
+        """ Take the next payload to send, or return None if all lanes are
+        empty.
+        """
+        while True:
+            payload = self.take_payload()
+            if payload is None or not self.is_blocked(payload):
+                return payload
+            self.drop_blocked(payload)
+
+    def take_payload(self):
+        for _ in range(len(self.schedule)):
+            lane = self.schedule[self.position]
+            self.position = (self.position + 1) % len(self.schedule)
+            if lane.queue:
+                return lane.queue.popleft()
+        return None
+
+    def is_blocked(self, payload):
+        return self.rate_limits.is_blocked(payload.category)
+
+    def drop_blocked(self, payload):
+        self.blocked += 1
+        if self.spill is not None:
+            self.spill([payload])
+
+    def run_sender(self):
+        sender = eventlet.getcurrent()
+        payload = self.next_payload()
+        while payload is not None:
+            self.in_flight[sender] = payload
+            self.send_with_retries(payload)
+            self.sent += 1
+            payload = self.next_payload()
+        self.in_flight.pop(sender, None)
+
+    def send_with_retries(self, payload):
+        self.retry_budget.deposit()
+        attempt = 0
+        while True:
+            result = self._send_payload(payload)
+            headers = getattr(result, 'headers', None)
+            if isinstance(result, Exception) and headers is not None:
+                # rejected; `_send_payload` returns the HTTPError
+                self.rate_limits.update(result.code, headers)
+            if not is_transient(result) and (
+                getattr(result, 'code', None) != 429
+            ):
+                return
+            if self.is_blocked(payload):
+                self.drop_blocked(payload)
+                return
+            if not (
+                attempt < self.retries and is_transient(result) and
+                self.retry_budget.withdraw()
+            ):
+                if self.spill is not None:
+                    self.spill([payload])
+                return
+            attempt += 1
+            self.retried += 1
+            eventlet.sleep(self.get_backoff(attempt))
+            # another sender may have been rate limited meanwhile
+            if self.is_blocked(payload):
+                self.drop_blocked(payload)
+                return
+
+    def get_backoff(self, attempt):
+        """ Return the delay before retry number `attempt`.
+        """
+        limit = min(
+            self.retry_backoff_max, self.retry_backoff * 2 ** (attempt - 1)
+        )
+        return random.uniform(0, limit)
+
+    def drain(self, timeout):
+        """ Stop accepting events and wait up to `timeout` seconds for
+        outstanding ones to be sent.
+
+        Returns the number of events flushed and a list of abandoned
+        payloads.
+        """
+        self.accepting = False
+        sent_before = self.sent
+        with eventlet.Timeout(timeout, False):
+            self.pool.waitall()
+        return self.sent - sent_before, self.kill()
+
+    def kill(self):
+        """ Stop accepting events and abandon any outstanding ones without
+        blocking.
+
+        Returns the abandoned payloads, including those in flight.
+        """
+        self.accepting = False
+        abandoned = list(self.in_flight.values())
+        self.in_flight.clear()
+        for lane in self.lanes.values():
+            abandoned.extend(lane.queue)
+            lane.queue.clear()
+        for gt in list(self.pool.coroutines_running):
+            gt.kill()
+        return abandoned
+
+
+def decode_payload(data):
+    """ Decode an event payload encoded by `raven.Client.encode`.
+    """
+    return json.loads(zlib.decompress(data).decode('utf-8'))
+
+
+def get_exception_types(event):
+    return [value.get('type') for value in get_exception_values(event)]
+
+
+def get_exception_values(event):
+    exception = event.get('exception') or {}
+    return exception.get('values') or []
+
+
+class RecordedEvents(list):
+    """ Decoded events recorded by `RecordingTransport`, in the order they
+    were sent.
+    """
+
+    @property
+    def last(self):
+        """ The most recently recorded event, or None.
+        """
+        return self[-1] if self else None
+
+    @property
+    def errors(self):
+        return self.filter(type=None)
+
+    @property
+    def transactions(self):
+        return self.filter(type='transaction')
+
+    def filter(
+        self, type=None, level=None, logger=None, exception=None, tags=None,
+        **fields
+    ):
+        """ Return the recorded events matching all of the given criteria.
+
+        `type` is None for error events and 'transaction' for traced
+        workers. `level` may be given by name or number, `exception` is
+        the name of an exception class in the event's chain and `tags` must
+        be a subset of the event's tags. Any other `fields` must equal the
+        top-level fields of the event.
+        """
+        # pylint: disable=redefined-builtin
+        if level is not None:
+            level = get_log_level(level)
+
+        def matches(event):
+            if event.get('type') != type:
+                return False
+            if level is not None and (
+                get_log_level(event.get('level')) != level
+            ):
+                return False
+            if logger is not None and event.get('logger') != logger:
+                return False
+            if exception is not None and (
+                exception not in get_exception_types(event)
+            ):
+                return False
+            if tags is not None:
+                event_tags = event.get('tags') or {}
+                if any(
+                    event_tags.get(key) != value
+                    for key, value in tags.items()
+                ):
+                    return False
+            return all(
+                event.get(key) == value for key, value in fields.items()
+            )
+
+        return RecordedEvents(event for event in self if matches(event))
+
+    def exception_types(self):
+        """ Return the name of the exception reported by each error event.
+        """
+        return [
+            get_exception_types(event)[-1]
+            for event in self.errors if get_exception_values(event)
+        ]
+
+    def clear(self):
+        del self[:]
+
+
+class RecordingTransport(QueuedEventletHTTPTransport):
+    """ Transport that records events in memory instead of sending them,
+    for use in tests.
+
+    Events are decoded and appended to `events` synchronously, by the
+    greenlet that sends them, so they can be asserted on as soon as the
+    worker has completed. Pass `events` to share one `RecordedEvents`
+    between several transports.
+    """
+
+    def __init__(self, events=None, **kwargs):
+        super(RecordingTransport, self).__init__(**kwargs)
+        self.events = RecordedEvents() if events is None else events
+
+    def send(self, url, data, headers):
+        if not self.accepting:
+            self.rejected += 1
+            return
+        self.events.append(decode_payload(data))
+        self.sent += 1
+
+
+MESSAGE_TEMPLATE = 'Unhandled exception in call {}: {} {!r}'
+
+# payload fields sent with slim references to remote errors
+REMOTE_REFERENCE_FIELDS = frozenset(['tags'])
+
+
+# operation names of traced workers and their spans
+TRANSACTION_OP = 'nameko.entrypoint'
+HTTP_TRANSACTION_OP = 'http.server'
+METHOD_SPAN_OP = 'nameko.method'
+DEPENDENCY_SPAN_OP = 'nameko.dependency'
+
+# cap on the number of spans recorded per traced worker
+MAX_SPANS = 1000
+
+# injected values that aren't traced as dependencies
+UNTRACED_TYPES = six.string_types + six.integer_types + (
+    float, bool, bytes, dict, list, tuple, set, frozenset, type(None),
+)
+
+
+def get_log_level(level):
+    """ Return the numeric value of a logging level given by name or number.
+    """
+    if isinstance(level, six.string_types):
+        return logging.getLevelName(level.upper())
+    return level
+
+
+class ReportingPolicy(object):
+    """ How failures of a single entrypoint are reported.
+
+    Policies are resolved once per entrypoint when the reporter is set up;
+    see `SentryReporter.build_policy`. `capture` is the set of payload
+    fields to build context for, or None for all of them.
+    """
+    __slots__ = (
+        'report', 'report_expected_exceptions', 'level', 'expected_level',
+        'sample_rate', 'capture', 'remote_capture', 'slim_remote_errors',
+        'logger', 'message_template', 'routes', 'traces_sample_rate',
+        'transaction_op',
+    )
+
+    def __init__(
+        self, logger, report=True, report_expected_exceptions=True,
+        level=logging.ERROR, expected_level=logging.WARNING, sample_rate=1.0,
+        capture=None, slim_remote_errors=False,
+        message_template=MESSAGE_TEMPLATE, routes=(), traces_sample_rate=0,
+        transaction_op=TRANSACTION_OP
+    ):
+        self.logger = logger
+        self.report = report
+        self.report_expected_exceptions = report_expected_exceptions
+        self.level = get_log_level(level)
+        self.expected_level = get_log_level(expected_level)
+        self.sample_rate = sample_rate
+        self.slim_remote_errors = slim_remote_errors
+        self.message_template = message_template
+        self.routes = tuple(routes)
+        self.traces_sample_rate = traces_sample_rate
+        self.transaction_op = transaction_op
+
+        self.capture = None
+        self.remote_capture = REMOTE_REFERENCE_FIELDS
+        if capture is not None:
+            self.capture = frozenset(capture)
+            self.remote_capture = self.capture & REMOTE_REFERENCE_FIELDS
+
+    def sampled(self):
+        return self.sample_rate >= 1 or random.random() < self.sample_rate
+
+    def traced(self):
+        rate = self.traces_sample_rate
+        return rate >= 1 or (rate > 0 and random.random() < rate)
+
+    def get_client(self, exc_info, default):
+        """ Return the client of the first route matching the type of
+        `exc_info`, or `default`.
+
+        `routes` is a sequence of `(exception name, client)`, already
+        narrowed down to the routes matching the entrypoint. An exception
+        name of None matches any exception.
+        """
+        names = None
+        for exception_name, client in self.routes:
+            if exception_name is None:
+                return client
+            if names is None:
+                names = frozenset(cls.__name__ for cls in exc_info[0].__mro__)
+            if exception_name in names:
+                return client
+        return default
+
+
+class Span(object):
+    """ A timed operation within a traced worker.
+    """
+    __slots__ = (
+        'span_id', 'parent_span_id', 'op', 'description', 'start_timestamp',
+        'timestamp',
+    )
+
+    def __init__(self, op, description, parent_span_id=None):
+        self.span_id = uuid.uuid4().hex[16:]
+        self.parent_span_id = parent_span_id
+        self.op = op
+        self.description = description
+        self.start_timestamp = time.time()
+        self.timestamp = None
+
+    def finish(self):
+        self.timestamp = time.time()
+
+    def to_dict(self, trace_id):
+        return {
+            'trace_id': trace_id,
+            'span_id': self.span_id,
+            'parent_span_id': self.parent_span_id,
+            'op': self.op,
+            'description': self.description,
+            'start_timestamp': self.start_timestamp,
+            'timestamp': self.timestamp,
+        }
+
+
+class Transaction(object):
+    """ The trace of a single worker: a root span from `worker_setup` to
+    `worker_teardown`, and child spans for the operations within it.
+
+    At most `MAX_SPANS` child spans are kept; further ones are counted in
+    `dropped_spans`.
+    """
+
+    def __init__(self, name, op):
+        self.name = name
+        self.trace_id = uuid.uuid4().hex
+        self.root = Span(op, name)
+        self.spans = []
+        self.dropped_spans = 0
+        self.status = 'ok'
+        self.tags = {}
+        self.request = None
+
+    def start_span(self, op, description):
+        span = Span(op, description, parent_span_id=self.root.span_id)
+        if len(self.spans) < MAX_SPANS:
+            self.spans.append(span)
+        else:
+            self.dropped_spans += 1
+        return span
+
+    def finish(self):
+        self.root.finish()
+
+    def to_event(self):
+        """ Return the transaction as sentry event data.
+        """
+        root = self.root
+        event = {
+            'type': 'transaction',
+            'event_id': uuid.uuid4().hex,
+            'transaction': self.name,
+            'start_timestamp': root.start_timestamp,
+            'timestamp': root.timestamp,
+            'contexts': {
+                'trace': {
+                    'trace_id': self.trace_id,
+                    'span_id': root.span_id,
+                    'op': root.op,
+                    'status': self.status,
+                },
+            },
+            'spans': [span.to_dict(self.trace_id) for span in self.spans],
+            'tags': self.tags,
+        }
+        if self.request is not None:
+            event['request'] = self.request
+        if self.dropped_spans:
+            event['extra'] = {'dropped_spans': self.dropped_spans}
+        return event
+
+
+class TracedDependency(wrapt.ObjectProxy):
+    """ Transparent proxy for a dependency injected into a traced worker.
+
+    Calls of the dependency, or of its attributes (and theirs, such as the
+    methods of a service behind an RPC proxy), are recorded as spans of
+    `transaction`. Attributes of `UNTRACED_TYPES` are passed through, and
+    everything else (setting attributes, item access, context management,
+    `isinstance` and so on) goes straight to the dependency.
+    """
+
+    def __init__(self, target, transaction, description):
+        super(TracedDependency, self).__init__(target)
+        self._self_transaction = transaction
+        self._self_description = description
+
+    def __getattr__(self, name):
+        # only called for attributes the proxy itself doesn't have
+        value = super(TracedDependency, self).__getattr__(name)
+        if isinstance(value, UNTRACED_TYPES):
+            return value
+        return TracedDependency(
+            value, self._self_transaction,
+            '{}.{}'.format(self._self_description, name)
+        )
+
+    def __call__(self, *args, **kwargs):
+        span = self._self_transaction.start_span(
+            DEPENDENCY_SPAN_OP, self._self_description
+        )
+        try:
+            return self.__wrapped__(*args, **kwargs)
+        finally:
+            span.finish()
+
+    def __repr__(self):
+        return '<TracedDependency {!r}>'.format(self.__wrapped__)
+
+
+def trace_method(method, transaction, description):
+    """ Wrap the entrypoint method of a traced worker, recording its call
+    as a span of `transaction`.
+    """
+    @wraps(method)
+    def traced(*args, **kwargs):
+        span = transaction.start_span(METHOD_SPAN_OP, description)
+        try:
+            return method(*args, **kwargs)
+        finally:
+            span.finish()
+    return traced
+
+
+# default length of the sliding window of entrypoint statistics, in seconds
+STATS_WINDOW = 60
+
+METRICS = (
+    ('calls', "Calls in the last {} seconds."),
+    ('errors', "Unexpected errors in the last {} seconds."),
+    ('expected_errors', "Expected errors in the last {} seconds."),
+    ('error_rate', "Proportion of calls in the last {} seconds that failed "
+                   "with an unexpected error."),
+)
+
+
+class SlidingWindow(object):
+    """ Counts of calls, errors and expected errors of an entrypoint over
+    the last `size` seconds.
+
+    The counts are kept in a fixed ring of per-second buckets, each reused
+    once its second has left the window.
+    """
+    __slots__ = ('size', 'seconds', 'calls', 'errors', 'expected_errors')
+
+    def __init__(self, size=STATS_WINDOW):
+        self.size = int(size)
+        self.seconds = [None] * self.size
+        self.calls = [0] * self.size
+        self.errors = [0] * self.size
+        self.expected_errors = [0] * self.size
+
+    def record(self, error=False, expected=False, now=None):
+        second = int(time.time() if now is None else now)
+        index = second % self.size
+        if self.seconds[index] != second:
+            self.seconds[index] = second
+            self.calls[index] = self.errors[index] = 0
+            self.expected_errors[index] = 0
+        self.calls[index] += 1
+        if expected:
+            self.expected_errors[index] += 1
+        elif error:
+            self.errors[index] += 1
+
+    def totals(self, now=None):
+        """ Return the counts over the window ending at `now`, and the
+        proportion of calls that failed with an unexpected error.
+        """
+        second = int(time.time() if now is None else now)
+        calls = errors = expected_errors = 0
+        for index, bucket in enumerate(self.seconds):
+            if bucket is not None and second - self.size < bucket <= second:
+                calls += self.calls[index]
+                errors += self.errors[index]
+                expected_errors += self.expected_errors[index]
+        return {
+            'calls': calls,
+            'errors': errors,
+            'expected_errors': expected_errors,
+            'error_rate': float(errors) / calls if calls else 0.0,
+        }
+
+
+def escape_label(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace(
+        '\n', '\\n'
+    )
+
+
+def render_metrics(service_name, stats, window=STATS_WINDOW):
+    """ Render entrypoint statistics, as returned by
+    `SentryReporter.get_stats`, in the Prometheus text format.
+    """
+    lines = []
+    for metric, description in METRICS:
+        name = 'nameko_sentry_{}'.format(metric)
+        lines.append('# HELP {} {}'.format(name, description.format(window)))
+        lines.append('# TYPE {} gauge'.format(name))
+        for key in sorted(stats):
+            entrypoint, method_name = key.split(':')
+            lines.append(
+                '{}{{service="{}",entrypoint="{}",method="{}"}} {!r}'.format(
+                    name, escape_label(service_name),
+                    escape_label(entrypoint), escape_label(method_name),
+                    stats[key][metric]
+                )
+            )
+    return '\n'.join(lines) + '\n'
+
+
+# cap on the number of distinct stacks attached to an event
+MAX_PROFILE_STACKS = 20
+
+SLOW_MESSAGE_TEMPLATE = 'Slow call {}: took {:.3f} seconds'
+
+
+class WorkerProfile(object):
+    """ Stack samples of a single worker's greenlet.
+    """
+    __slots__ = ('greenlet', 'started', 'samples')
+
+    def __init__(self, greenlet, max_samples):
+        self.greenlet = greenlet
+        self.started = timer()
+        self.samples = deque(maxlen=max_samples)
+
+
+class Profiler(object):
+    """ Low-frequency sampling profiler over the greenlets of active
+    workers.
+
+    Every `interval` seconds, the stack of each worker greenlet is sampled
+    from its suspended frame, keeping the last `max_samples` stacks of at
+    most `max_depth` frames per worker. Greenlets are only suspended when
+    they yield to the hub, so samples show where workers wait (or where
+    they last yielded) rather than time spent on CPU.
+
+    The time spent sampling is measured, and the interval is stretched so
+    that it stays under `max_overhead` of the elapsed time. Workers that
+    take longer than `threshold` seconds are reported as slow.
+    """
+
+    def __init__(
+        self, interval=0.05, threshold=None, max_samples=100, max_depth=32,
+        max_overhead=0.01
+    ):
+        self.interval = float(interval)
+        self.threshold = threshold
+        self.max_samples = int(max_samples)
+        self.max_depth = int(max_depth)
+        self.max_overhead = float(max_overhead)
+        self.workers = {}
+        self.busy = 0.0
+        self.started = None
+
+    @property
+    def overhead(self):
+        """ Proportion of the time since the profiler started spent
+        sampling.
+        """
+        if self.started is None:
+            return 0.0
+        elapsed = timer() - self.started
+        return self.busy / elapsed if elapsed else 0.0
+
+    def add(self, worker_ctx):
+        """ Start profiling the worker of `worker_ctx`, which must be
+        running in the current greenlet.
+        """
+        self.workers[worker_ctx] = WorkerProfile(
+            eventlet.getcurrent(), self.max_samples
+        )
+
+    def get(self, worker_ctx):
+        return self.workers.get(worker_ctx)
+
+    def remove(self, worker_ctx):
+        self.workers.pop(worker_ctx, None)
+
+    def get_stack(self, frame):
+        stack = []
+        while frame is not None and len(stack) < self.max_depth:
+            stack.append((
+                frame.f_globals.get('__name__'), frame.f_code.co_name,
+                frame.f_lineno
+            ))
+            frame = frame.f_back
+        return tuple(stack)
+
+    def sample(self):
+        for profile in self.workers.values():
+            frame = profile.greenlet.gr_frame
+            if frame is not None:
+                profile.samples.append(self.get_stack(frame))
+
+    def tick(self):
+        """ Sample all workers once, and return the delay until the next
+        pass.
+        """
+        start = timer()
+        self.sample()
+        duration = timer() - start
+        self.busy += duration
+        return max(self.interval, duration / self.max_overhead - duration)
+
+    def run(self):
+        self.started = timer()
+        while True:
+            eventlet.sleep(self.tick())
+
+    def aggregate(self, profile):
+        """ Return the most common stacks sampled for `profile`, outermost
+        frame first, with their counts.
+        """
+        counts = Counter(profile.samples)
+        return {
+            'samples': len(profile.samples),
+            'interval': self.interval,
+            'stacks': [
+                {
+                    'count': count,
+                    'frames': [
+                        '{}.{}:{}'.format(*frame) for frame in reversed(stack)
+                    ],
+                }
+                for stack, count in counts.most_common(MAX_PROFILE_STACKS)
+            ],
+        }
+
+
+def noop(*args, **kwargs):
+    pass
+
+
+class NullContext(Context):
+    """ Stand-in for `raven.context.Context` that discards everything
+    merged into it.
+
+    It is never activated, so raven's breadcrumb hooks don't record to it.
+    """
+    def __init__(self):
+        self._client = None
+        self.data = {}
+        self.exceptions_to_skip = set()
+        self.breadcrumbs = make_buffer(False)
+
+    merge = set = activate = deactivate = clear = staticmethod(noop)
+
+
+class NullClient(Client):
+    """ Stand-in for `raven.Client` used when no DSN is configured.
+
+    A raven client without a DSN or raven's hooks, which accepts the same
+    calls but discards events and context.
+    """
+    def __init__(self):
+        super(NullClient, self).__init__(
+            dsn=None, install_sys_hook=False, install_logging_hook=False,
+            hook_libraries=[], enable_breadcrumbs=False
+        )
+        self._context = NullContext()
+
+    def should_capture(self, exc_info):
+        return False
+
+    capture = send = send_remote = send_encoded = staticmethod(noop)
+    captureBreadcrumb = capture_breadcrumb = staticmethod(noop)
+
+
+# the reporter and worker context of the worker running in each greenlet
+current_worker = local()
+
+# payload fields built for events captured by the service itself
+REQUEST_FIELDS = frozenset(['request'])
+
+
+class WorkerClient(Client):
+    """ Raven client of a `SentryReporter`.
+
+    Events captured by the service itself through the reporter dependency
+    carry the HTTP context of the current worker. It's built by the first
+    such capture, rather than for every worker.
+    """
+    def capture(self, event_type, **kwargs):
+        worker = getattr(current_worker, 'worker', None)
+        if worker is not None:
+            reporter, worker_ctx = worker
+            reporter.build_pending_context(worker_ctx)
+        return super(WorkerClient, self).capture(event_type, **kwargs)
 
 
 class SentryReporter(DependencyProvider):
     """ Send exceptions generated by entrypoints to a sentry server.
     """
 
+    transport_cls = QueuedEventletHTTPTransport
+
     def setup(self):
         sentry_config = self.container.config.get('SENTRY')
 
@@ -28,7 +1830,66 @@ class SentryReporter(DependencyProvider):
         dsn = sentry_config.get('DSN', None)
         kwargs = sentry_config.get('CLIENT_CONFIG', {})
 
-        self.client = Client(dsn, transport=EventletHTTPTransport, **kwargs)
+        self.client_config = kwargs
+        self.fingerprinter = Fingerprinter(
+            include_paths=kwargs.get('include_paths') or (),
+            exclude_paths=kwargs.get('exclude_paths') or (),
+        )
+        transport_cls = sentry_config.get('TRANSPORT')
+        if isinstance(transport_cls, six.string_types):
+            transport_cls = import_string(transport_cls)
+        if transport_cls is not None and not (
+            isinstance(transport_cls, type) and
+            issubclass(transport_cls, QueuedEventletHTTPTransport)
+        ):
+            raise ValueError(
+                "TRANSPORT must be a subclass of "
+                "QueuedEventletHTTPTransport, not {!r}".format(transport_cls)
+            )
+        self.transport_cls = transport_cls or self.transport_cls
+        self.transport_options = sentry_config.get('TRANSPORT_OPTIONS', {})
+        self.retry_budget = RetryBudget(
+            **sentry_config.get('RETRY_BUDGET', {})
+        )
+        self.route_config = sentry_config.get('ROUTES', ())
+        self.route_clients = {}
+        stats_window = sentry_config.get('STATS_WINDOW')
+        self.stats_address = sentry_config.get('STATS_ADDRESS')
+        self.stats_server = None
+        self.spool = sentry_config.get('SPOOL')
+        if dsn or os.environ.get('SENTRY_DSN'):
+            self.client = self.make_client(dsn)
+            self.stats_window = (
+                STATS_WINDOW if stats_window is None else stats_window
+            )
+        else:
+            # disabled; don't pay for reporting on every worker, nor for
+            # statistics unless `STATS_WINDOW` asks for them
+            self.client = NullClient()
+            self.stats_window = stats_window or 0
+            self.worker_setup = self.worker_teardown = noop
+            self.worker_result = (
+                self.record_stats if self.stats_window else noop
+            )
+        self.drain_timeout = sentry_config.get('DRAIN_TIMEOUT', 5)
+        self.build_threads = sentry_config.get('BUILD_THREADS', 0)
+        self.build_semaphore = Semaphore(self.build_threads or 1)
+        self.active_workers = 0
+        self.in_flight = defaultdict(int)
+        self.skipped = defaultdict(int)
+        self.dedup = self.load_dedup(sentry_config.get('DEDUP'))
+        self.profiler = None
+        self.profiler_thread = None
+        profiler_config = sentry_config.get('PROFILER')
+        if profiler_config and self.client.is_enabled():
+            if profiler_config is True:
+                profiler_config = {}
+            self.profiler = Profiler(**profiler_config)
+        self.traces_sample_rate = sentry_config.get('TRACES_SAMPLE_RATE', 0)
+        self.trace_dependencies = sentry_config.get(
+            'TRACE_DEPENDENCIES', False
+        )
+        self.transactions = {}
 
         report_expected_exceptions = sentry_config.get(
             'REPORT_EXPECTED_EXCEPTIONS', True
@@ -40,15 +1901,184 @@ class SentryReporter(DependencyProvider):
             'TAG_TYPE_CONTEXT_KEYS', TAG_TYPE_CONTEXT_KEYS
         )
 
+        slim_remote_errors = sentry_config.get('SLIM_REMOTE_ERRORS', False)
+
         self.report_expected_exceptions = report_expected_exceptions
+        self.slim_remote_errors = slim_remote_errors
         self.user_type_context_keys = user_type_context_keys
         self.tag_type_context_keys = tag_type_context_keys
+        self.scrubber = load_scrubber(sentry_config.get('SCRUB'))
+        self.http_headers = sentry_config.get('HTTP_HEADERS')
+        self.http_environ = sentry_config.get('HTTP_ENVIRON', HTTP_ENVIRON)
+
+        stages = [
+            load_stage(spec) for spec in
+            sentry_config.get('CONTEXT_PIPELINE', CONTEXT_PIPELINE)
+        ]
+        for stage in stages:
+            stage.setup(self)
+        self.pipeline = ContextPipeline(
+            stages, timed=sentry_config.get('STAGE_TIMING', False)
+        )
+
+        self.memory_debug = bool(
+            sentry_config.get('MEMORY_DEBUG', False) and tracemalloc
+        )
+        self.memory_stats = deque(maxlen=MEMORY_STATS_SIZE)
+        self.started_tracemalloc = False
+        if self.memory_debug and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self.started_tracemalloc = True
+
+        self.entrypoint_config = sentry_config.get('ENTRYPOINTS', {})
+        self.policies = {
+            entrypoint: self.build_policy(entrypoint)
+            for entrypoint in self.container.entrypoints
+        }
+        self.windows = {}
+        if self.stats_window:
+            self.windows = {
+                entrypoint: SlidingWindow(self.stats_window)
+                for entrypoint in self.container.entrypoints
+            }
+
+    def load_dedup(self, config):
+        """ Open the host-wide deduplication table configured by `DEDUP`,
+        or return None.
+
+        Reporting goes on without deduplication if the table can't be
+        opened.
+        """
+        if not config or not self.client.is_enabled():
+            return None
+        if config is True:
+            config = {}
+        try:
+            return SharedDedup(**config)
+        except (EnvironmentError, ValueError, mmap.error) as exc:
+            log.warning("Sentry reporter deduplication disabled: %s", exc)
+            return None
+
+    def make_client(self, dsn):
+        """ Create a client for `dsn`, with its own transport and queue.
+        """
+        client = WorkerClient(
+            dsn, transport=self.transport_cls, **self.client_config
+        )
+        client.remote.options.update(self.transport_options)
+        client.remote.options['retry_budget'] = self.retry_budget
+        if self.spool:
+            client.remote.options['spill'] = self.write_spool
+        return client
+
+    def get_route_client(self, dsn):
+        try:
+            return self.route_clients[dsn]
+        except KeyError:
+            client = self.route_clients[dsn] = self.make_client(dsn)
+            return client
+
+    def build_routes(self, entrypoint):
+        """ Resolve the `ROUTES` that may apply to `entrypoint`.
+
+        Routes are matched in order on `SERVICE` (the service name),
+        `ENTRYPOINT` (the name of the entrypoint's class or a base class),
+        `METHOD` (a shell-style pattern) and `EXCEPTION` (the name of the
+        exception's class or a base class); omitted keys match anything.
+        All but `EXCEPTION` are known up front, so only matching routes
+        are kept, as `(exception name, client)` pairs.
+        """
+        if not self.client.is_enabled():
+            return ()
+
+        entrypoint_names = frozenset(
+            cls.__name__ for cls in type(entrypoint).__mro__
+        )
+        routes = []
+        for route in self.route_config:
+            if route.get('SERVICE', self.container.service_name) != (
+                self.container.service_name
+            ):
+                continue
+            if route.get('ENTRYPOINT', 'Entrypoint') not in entrypoint_names:
+                continue
+            if not fnmatch.fnmatchcase(
+                entrypoint.method_name, route.get('METHOD', '*')
+            ):
+                continue
+            routes.append((
+                route.get('EXCEPTION'), self.get_route_client(route['DSN'])
+            ))
+        return routes
+
+    def policy_keys(self, entrypoint):
+        """ Return the `ENTRYPOINTS` config keys that apply to `entrypoint`,
+        least specific first.
+
+        These are the names of the entrypoint's classes (base classes
+        first), its method name, and `<class name>:<method name>`.
+        """
+        entrypoint_cls = type(entrypoint)
+        keys = [cls.__name__ for cls in reversed(entrypoint_cls.__mro__)]
+        keys.append(entrypoint.method_name)
+        keys.append(
+            '{}:{}'.format(entrypoint_cls.__name__, entrypoint.method_name)
+        )
+        return keys
+
+    def build_policy(self, entrypoint):
+        """ Resolve the `ReportingPolicy` for `entrypoint` from config.
+        """
+        settings = {}
+        for key in self.policy_keys(entrypoint):
+            settings.update(self.entrypoint_config.get(key, {}))
+
+        return ReportingPolicy(
+            logger='{}.{}'.format(
+                self.container.service_name, entrypoint.method_name
+            ),
+            report=settings.get('REPORT', True),
+            report_expected_exceptions=settings.get(
+                'REPORT_EXPECTED_EXCEPTIONS', self.report_expected_exceptions
+            ),
+            level=settings.get('LEVEL', logging.ERROR),
+            expected_level=settings.get('EXPECTED_LEVEL', logging.WARNING),
+            sample_rate=settings.get('SAMPLE_RATE', 1.0),
+            capture=settings.get('CAPTURE'),
+            slim_remote_errors=settings.get(
+                'SLIM_REMOTE_ERRORS', self.slim_remote_errors
+            ),
+            message_template=settings.get('MESSAGE', MESSAGE_TEMPLATE),
+            routes=self.build_routes(entrypoint),
+            traces_sample_rate=settings.get(
+                'TRACES_SAMPLE_RATE', self.traces_sample_rate
+            ),
+            transaction_op=self.get_transaction_op(entrypoint),
+        )
+
+    def get_transaction_op(self, entrypoint):
+        """ Return the operation name of transactions traced for
+        `entrypoint`.
+        """
+        handlers = sys.modules.get('nameko.web.handlers')
+        if handlers is not None and isinstance(
+            entrypoint, handlers.HttpRequestHandler
+        ):
+            return HTTP_TRANSACTION_OP
+        return TRANSACTION_OP
+
+    def get_policy(self, entrypoint):
+        try:
+            return self.policies[entrypoint]
+        except KeyError:
+            policy = self.policies[entrypoint] = self.build_policy(entrypoint)
+            return policy
 
     def format_message(self, worker_ctx, exc_info):
         exc_type, exc, _ = exc_info
-        return (
-            'Unhandled exception in call {}: '
-            '{} {!r}'.format(worker_ctx.call_id, exc_type.__name__, str(exc))
+        policy = self.get_policy(worker_ctx.entrypoint)
+        return policy.message_template.format(
+            worker_ctx.call_id, exc_type.__name__, str(exc)
         )
 
     def is_expected_exception(self, worker_ctx, exc_info):
@@ -57,117 +2087,966 @@ class SentryReporter(DependencyProvider):
             worker_ctx.entrypoint, 'expected_exceptions', tuple())
         return isinstance(exc, expected_exceptions)
 
+    def is_remote_exception(self, worker_ctx, exc_info):
+        """ Return True if the exception was propagated from another service.
+
+        A `RemoteError` means the failure originated in a downstream hop,
+        which reports the full payload itself if it runs a `SentryReporter`.
+        """
+        _, exc, _ = exc_info
+        return isinstance(exc, RemoteError)
+
+    def root_call_id(self, worker_ctx):
+        """ Return the call id at the root of the worker's call chain.
+
+        Every hop of a cascading failure shares this value, so it correlates
+        the events reported by each service. Note that nameko only tracks
+        `PARENT_CALLS_TRACKED` ancestors, so for very deep chains this is
+        the oldest tracked call rather than the true origin.
+        """
+        return worker_ctx.call_id_stack[0]
+
     def get_dependency(self, worker_ctx):
         """ Expose the Raven Client directly to the worker
         """
         return self.client
 
+    def build_context(self, worker_ctx, exc_info, fields=None):
+        """ Run the context pipeline and merge its payload into the client
+        context.
+
+        If given, `fields` limits the pipeline to stages that write any of
+        those payload fields, and the merged payload to those fields.
+        """
+        current_worker.pending_context = False
+        payload = self.pipeline.run(worker_ctx, exc_info, fields)
+        self.client.context.merge(payload)
+
+    def build_pending_context(self, worker_ctx):
+        """ Build the HTTP context of `worker_ctx` for an event captured by
+        the service itself, unless the worker's context has been built
+        already.
+        """
+        if not getattr(current_worker, 'pending_context', False):
+            return
+        fields = self.get_policy(worker_ctx.entrypoint).capture
+        if fields is None:
+            fields = REQUEST_FIELDS
+        self.build_context(worker_ctx, None, fields=fields & REQUEST_FIELDS)
+
     def http_context(self, worker_ctx):
-        """ Attempt to extract HTTP context if an HTTP entrypoint was used.
+        """ Merge the HTTP context of `worker_ctx` into the client context.
+
+        Kept for compatibility; context is built by the stages of the
+        context pipeline.
         """
-        http = {}
-        if isinstance(worker_ctx.entrypoint, HttpRequestHandler):
-            try:
-                request = worker_ctx.args[0]
-                try:
-                    if request.mimetype == 'application/json':
-                        data = request.data
-                    else:
-                        data = request.form
-                except ClientDisconnected:
-                    data = {}
-
-                urlparts = urlsplit(request.url)
-                http.update({
-                    'url': '{}://{}{}'.format(
-                        urlparts.scheme, urlparts.netloc, urlparts.path
-                    ),
-                    'query_string': urlparts.query,
-                    'method': request.method,
-                    'data': data,
-                    'headers': dict(get_headers(request.environ)),
-                    'env': dict(get_environ(request.environ)),
-                })
-            except:
-                pass  # probably not a compatible entrypoint
-
-        self.client.http_context(http)
+        self.build_context(worker_ctx, None, fields=REQUEST_FIELDS)
 
     def user_context(self, worker_ctx, exc_info):
-        """ Merge any user context to include in the sentry payload.
+        """ Merge the user context of `worker_ctx` into the client context.
 
-        Extracts user identifiers from the worker context data by matching
-        context keys with
+        Kept for compatibility, like `http_context`.
         """
-        user = {}
-        for key in worker_ctx.context_data:
-            for matcher in self.user_type_context_keys:
-                if re.search(matcher, key):
-                    user[key] = worker_ctx.context_data[key]
-                    break
-
-        self.client.user_context(user)
+        self.build_context(worker_ctx, exc_info, fields=frozenset(['user']))
 
     def tags_context(self, worker_ctx, exc_info):
-        """ Merge any tags to include in the sentry payload.
-        """
-        tags = {
-            'call_id': worker_ctx.call_id,
-            'parent_call_id': worker_ctx.immediate_parent_call_id,
-            'service_name': worker_ctx.container.service_name,
-            'method_name': worker_ctx.entrypoint.method_name
-        }
-        for key in worker_ctx.context_data:
-            for matcher in self.tag_type_context_keys:
-                if re.search(matcher, key):
-                    tags[key] = worker_ctx.context_data[key]
-                    break
+        """ Merge the tags of `worker_ctx` into the client context.
 
-        self.client.tags_context(tags)
+        Kept for compatibility, like `http_context`.
+        """
+        self.build_context(worker_ctx, exc_info, fields=frozenset(['tags']))
 
     def extra_context(self, worker_ctx, exc_info):
-        """ Merge any extra context to include in the sentry payload.
+        """ Merge the extra context of `worker_ctx` into the client context.
 
-        Includes all available worker context data.
+        Kept for compatibility, like `http_context`.
         """
-        extra = {}
-        extra.update(worker_ctx.context_data)
+        self.build_context(worker_ctx, exc_info, fields=frozenset(['extra']))
 
-        self.client.extra_context(extra)
+    def get_stage_timings(self):
+        """ Return per-stage timings of the context pipeline.
+
+        Only collected if `STAGE_TIMING` is enabled.
+        """
+        return self.pipeline.get_timings()
 
     def worker_setup(self, worker_ctx):
-        self.http_context(worker_ctx)
+        self.active_workers += 1
+        self.in_flight[worker_ctx.entrypoint] += 1
+        # activate the context so breadcrumbs recorded by the worker are kept
+        self.client.context.activate()
+        current_worker.worker = (self, worker_ctx)
+        current_worker.pending_context = True
+
+        if self.profiler is not None:
+            self.profiler.add(worker_ctx)
+
+        policy = self.get_policy(worker_ctx.entrypoint)
+        if policy.traced() and not self.is_rate_limited(
+            self.client, TRANSACTION_CATEGORY
+        ):
+            self.transactions[worker_ctx] = self.start_transaction(
+                worker_ctx, policy
+            )
 
     def worker_result(self, worker_ctx, result, exc_info):
+        if self.stats_window:
+            self.record_stats(worker_ctx, result, exc_info)
+
         if exc_info is None:
+            if self.profiler is not None:
+                self.report_slow_worker(worker_ctx)
+            return
+
+        transaction = self.transactions.get(worker_ctx)
+        if transaction is not None:
+            transaction.status = 'internal_error'
+
+        policy = self.get_policy(worker_ctx.entrypoint)
+        if not policy.report:
+            return
+        if self.get_level(worker_ctx, exc_info) is None:
+            return
+        if not policy.sampled():
             return
 
-        self.user_context(worker_ctx, exc_info)
-        self.tags_context(worker_ctx, exc_info)
-        self.extra_context(worker_ctx, exc_info)
+        client = self.get_client(worker_ctx, exc_info)
+        if (
+            policy.slim_remote_errors and
+            self.is_remote_exception(worker_ctx, exc_info)
+        ):
+            if self.is_rate_limited(client, DEFAULT_CATEGORY):
+                return
+            self.build_context(
+                worker_ctx, exc_info, fields=policy.remote_capture
+            )
+            self.capture_remote_reference(worker_ctx, exc_info)
+            return
 
-        self.capture_exception(worker_ctx, exc_info)
+        if self.is_rate_limited(client, ERROR_CATEGORY):
+            return
+        if not self.should_capture(exc_info):
+            return
+        fingerprint = self.fingerprint(exc_info)
+        if self.is_duplicate(fingerprint):
+            return
+        self.build_context(worker_ctx, exc_info, fields=policy.capture)
+        self.capture_exception(worker_ctx, exc_info, fingerprint)
 
     def worker_teardown(self, worker_ctx):
+        self.active_workers -= 1
+        self.in_flight[worker_ctx.entrypoint] -= 1
         self.client.context.clear(deactivate=True)
+        current_worker.worker = None
+        current_worker.pending_context = False
 
-    def capture_exception(self, worker_ctx, exc_info):
-        message = self.format_message(worker_ctx, exc_info)
+        if self.profiler is not None:
+            self.profiler.remove(worker_ctx)
+
+        transaction = self.transactions.pop(worker_ctx, None)
+        if transaction is not None:
+            transaction.finish()
+            self.send_transaction(transaction)
+
+    def get_window(self, entrypoint):
+        try:
+            return self.windows[entrypoint]
+        except KeyError:
+            window = self.windows[entrypoint] = SlidingWindow(
+                self.stats_window
+            )
+            return window
+
+    def record_stats(self, worker_ctx, result, exc_info):
+        """ Count the worker's call, and its error if it failed, in the
+        sliding window of its entrypoint.
+        """
+        window = self.get_window(worker_ctx.entrypoint)
+        if exc_info is None:
+            window.record()
+        else:
+            window.record(
+                error=True,
+                expected=self.is_expected_exception(worker_ctx, exc_info)
+            )
+
+    def get_stats(self, now=None):
+        """ Return the calls, errors, expected errors and error rate of
+        each entrypoint over the last `STATS_WINDOW` seconds.
 
-        logger = '{}.{}'.format(
-            worker_ctx.service_name, worker_ctx.entrypoint.method_name
+        Entrypoints are keyed by `<class name>:<method name>`.
+        """
+        return {
+            '{}:{}'.format(
+                type(entrypoint).__name__, entrypoint.method_name
+            ): window.totals(now)
+            for entrypoint, window in six.iteritems(self.windows)
+        }
+
+    def serve_stats(self, environ, start_response):
+        """ WSGI application serving `get_stats` at `/metrics`, in the
+        Prometheus text format.
+        """
+        if environ['PATH_INFO'] != '/metrics':
+            start_response('404 Not Found', [('Content-Type', 'text/plain')])
+            return [b'Not Found\n']
+        body = render_metrics(
+            self.container.service_name, self.get_stats(), self.stats_window
+        )
+        start_response('200 OK', [
+            ('Content-Type', 'text/plain; version=0.0.4; charset=utf-8'),
+        ])
+        return [body.encode('utf-8')]
+
+    def stop_stats_server(self):
+        if self.stats_server is not None:
+            self.stats_server.kill()
+            self.stats_socket.close()
+            self.stats_server = None
+
+    def stop_profiler(self):
+        if self.profiler_thread is not None:
+            self.profiler_thread.kill()
+            self.profiler_thread = None
+
+    def is_rate_limited(self, client, category):
+        """ Return True if sentry has asked `client` not to send events of
+        `category` for now, counting the event in `skipped`.
+
+        This is checked before anything is built for the event, so events
+        are dropped cheaply until the limit expires.
+        """
+        transport = client.remote.get_transport()
+        if not transport.rate_limits.is_blocked(category):
+            return False
+        self.skipped[category] += 1
+        return True
+
+    def is_duplicate(self, fingerprint):
+        """ Return True if an event with the same `fingerprint` was
+        reported by any process on the host within the `DEDUP` window,
+        counting it in `skipped`.
+
+        Otherwise, the number of duplicates suppressed since the last
+        report is added to the event's extra context.
+        """
+        if self.dedup is None:
+            return False
+        suppressed = self.dedup.check(fingerprint)
+        if suppressed is None:
+            self.skipped['duplicate'] += 1
+            return True
+        if suppressed:
+            self.client.extra_context({'suppressed_duplicates': suppressed})
+        return False
+
+    def start_transaction(self, worker_ctx, policy):
+        """ Start tracing a sampled worker.
+
+        The entrypoint method and the other dependencies injected into the
+        service instance are wrapped to record spans. Only sampled workers
+        pay for this; other workers get no span objects at all.
+        """
+        entrypoint = worker_ctx.entrypoint
+        service_name = self.container.service_name
+        transaction = Transaction(
+            '{}.{}'.format(service_name, entrypoint.method_name),
+            policy.transaction_op
         )
+        transaction.tags.update({
+            'service_name': service_name,
+            'method_name': entrypoint.method_name,
+            'call_id': worker_ctx.call_id,
+        })
+        if policy.transaction_op == HTTP_TRANSACTION_OP:
+            request = worker_ctx.args[0]
+            transaction.request = {
+                'method': request.method,
+                'url': request.base_url,
+            }
+
+        service = worker_ctx.service
+        if self.trace_dependencies:
+            for provider in self.container.dependencies:
+                if provider is self:
+                    continue
+                value = getattr(service, provider.attr_name, None)
+                if isinstance(value, UNTRACED_TYPES):
+                    continue
+                setattr(service, provider.attr_name, TracedDependency(
+                    value, transaction, provider.attr_name
+                ))
+
+        method = getattr(service, entrypoint.method_name)
+        setattr(service, entrypoint.method_name, trace_method(
+            method, transaction, entrypoint.method_name
+        ))
+        return transaction
+
+    def send_transaction(self, transaction):
+        """ Send a finished transaction in the transport's `transaction`
+        lane.
+        """
+        client = self.client
+        data = transaction.to_event()
+        data.update({
+            'project': client.remote.project,
+            'server_name': client.name,
+            'platform': 'python',
+            'sdk': SDK_VALUE,
+        })
+        if client.site:
+            data['tags'].setdefault('site', client.site)
+        if client.release:
+            data['release'] = client.release
+        if client.environment:
+            data['environment'] = client.environment
+
+        transport = client.remote.get_transport()
+        with transport.use_lane('transaction', TRANSACTION_CATEGORY):
+            client.send(**data)
+
+    def start(self):
+        if self.client.is_enabled():
+            self.container.spawn_managed_thread(self.prewarm)
+        if self.profiler is not None:
+            self.profiler_thread = self.container.spawn_managed_thread(
+                self.profiler.run
+            )
+        if self.stats_window and self.stats_address:
+            host, port = self.stats_address.rsplit(':', 1)
+            self.stats_socket = eventlet.listen((host, int(port)))
+            self.stats_server = self.container.spawn_managed_thread(partial(
+                wsgi.server, self.stats_socket, self.serve_stats,
+                log_output=False
+            ))
+
+    def prewarm(self):
+        """ Create the parts of the client that raven otherwise creates
+        when the first event is sent.
+        """
+        self.get_transports()
+        self.client.get_handler('nameko_sentry.DetachedExceptionEvent')
+        for _ in self.client.get_processors():
+            pass
+        self.client.get_module_versions()
 
+    def get_level(self, worker_ctx, exc_info):
+        """ Return the level to report `exc_info` at, or None to skip it.
+        """
+        policy = self.get_policy(worker_ctx.entrypoint)
         if self.is_expected_exception(worker_ctx, exc_info):
-            if not self.report_expected_exceptions:
-                return  # nothing to do
-            level = logging.WARNING
-        else:
-            level = logging.ERROR
+            if not policy.report_expected_exceptions:
+                return None
+            return policy.expected_level
+        return policy.level
+
+    def get_transports(self):
+        clients = [self.client]
+        clients.extend(self.route_clients.values())
+        transports = (client.remote.get_transport() for client in clients)
+        return [transport for transport in transports if transport]
+
+    def stop(self):
+        """ Flush outstanding events, waiting at most `DRAIN_TIMEOUT`
+        seconds. Each transport is drained concurrently.
+        """
+        transports = self.get_transports()
+        pool = GreenPool(len(transports) or 1)
+        for flushed, abandoned in pool.imap(
+            lambda transport: transport.drain(self.drain_timeout), transports
+        ):
+            log.info(
+                "Sentry reporter flushed %d events on stop, abandoned %d",
+                flushed, len(abandoned)
+            )
+            self.spill(abandoned)
+        self.stop_stats_server()
+        self.stop_profiler()
+        self.close_dedup()
+        self.stop_tracemalloc()
+
+    def kill(self):
+        """ Abandon outstanding events immediately.
+        """
+        for transport in self.get_transports():
+            self.spill(transport.kill())
+        self.stop_stats_server()
+        self.stop_profiler()
+        self.close_dedup()
+        self.stop_tracemalloc()
+
+    def spill(self, payloads):
+        """ Handle events abandoned by the transport.
+
+        If `SPOOL` is configured, the events are appended to that file, one
+        JSON object per line, to be replayed later with
+        `nameko-sentry replay`.
+        """
+        if not payloads:
+            return
+        log.warning("Sentry reporter abandoned %d events", len(payloads))
+        if self.spool:
+            self.write_spool(payloads)
+
+    def write_spool(self, payloads):
+        """ Append `payloads` to the `SPOOL` file.
+
+        Also called by the transport with events that are dropped or fail
+        to send while the container is running.
+        """
+        try:
+            with open(self.spool, 'a') as spool:
+                for _, data, _ in payloads:
+                    spool.write(json.dumps(self.client.decode(data)) + '\n')
+        except EnvironmentError as exc:
+            log.warning(
+                "Sentry reporter failed to spool %d events: %s",
+                len(payloads), exc
+            )
+
+    def close_dedup(self):
+        if self.dedup is not None:
+            self.dedup.close()
+            self.dedup = None
+
+    def stop_tracemalloc(self):
+        if self.started_tracemalloc:
+            tracemalloc.stop()
+            self.started_tracemalloc = False
+
+    def snapshot_exception(self, exc_info):
+        """ Return a detached, frame-free representation of `exc_info`.
+
+        This is raven's `exception` interface, with frame locals already
+        transformed into plain data, so nothing built from it keeps the
+        traceback (and every local variable of the failing stack) alive.
+        Returns None unless `should_capture`.
+        """
+        if not self.should_capture(exc_info):
+            return None
+        client = self.client
+        client.record_exception_seen(exc_info)
+        client.context.exceptions_to_skip.add(id(exc_info[1]))
+
+        handler = client.get_handler('raven.events.Exception')
+        return handler.capture(exc_info=exc_info)['exception']
+
+    def should_capture(self, exc_info):
+        """ Return False if the client would not capture `exc_info`, or if
+        it has already been captured by this worker.
+        """
+        client = self.client
+        # raven's key depends on the traceback, which differs once an
+        # exception logged with `SentryHandler` is raised out of the worker
+        return (
+            client.is_enabled() and
+            not client.skip_error_for_logging(exc_info) and
+            id(exc_info[1]) not in client.context.exceptions_to_skip and
+            client.should_capture(exc_info)
+        )
+
+    def fingerprint(self, exc_info):
+        """ Return the local fingerprint of `exc_info`, which is also sent
+        as the event's `fingerprint`.
+        """
+        return self.fingerprinter.fingerprint(exc_info)
+
+    def capture_exception(self, worker_ctx, exc_info, fingerprint=None):
+        message = self.format_message(worker_ctx, exc_info)
+        logger = self.get_policy(worker_ctx.entrypoint).logger
+
+        level = self.get_level(worker_ctx, exc_info)
+        if level is None:
+            return  # nothing to do
+
+        if self.memory_debug:
+            gc.collect()
+            memory_before = tracemalloc.get_traced_memory()[0]
+            objects_before = len(gc.get_objects())
+
+        exception = self.snapshot_exception(exc_info)
+        if exception is None:
+            return
+        if fingerprint is None:
+            fingerprint = self.fingerprint(exc_info)
+
+        data = {
+            'logger': logger,
+            'level': level,
+            'exception': exception,
+            'fingerprint': [fingerprint],
+        }
+        profile = self.get_profile(worker_ctx)
+        if profile is not None:
+            data['contexts'] = {'stack_profile': profile}
+
+        event_id = self.capture(
+            self.get_client(worker_ctx, exc_info),
+            'nameko_sentry.DetachedExceptionEvent', message=message, data=data
+        )
+
+        if self.memory_debug:
+            del data
+            gc.collect()
+            self.record_memory_stats(
+                event_id,
+                tracemalloc.get_traced_memory()[0] - memory_before,
+                len(gc.get_objects()) - objects_before
+            )
+
+    def get_profile(self, worker_ctx):
+        """ Return the aggregated stack profile of the worker, or None if
+        it isn't being profiled or has no samples.
+        """
+        if self.profiler is None:
+            return None
+        profile = self.profiler.get(worker_ctx)
+        if profile is None or not profile.samples:
+            return None
+        return self.profiler.aggregate(profile)
+
+    def report_slow_worker(self, worker_ctx):
+        """ Send a warning with the stack profile of a worker that took
+        longer than the profiler's `threshold`.
+        """
+        threshold = self.profiler.threshold
+        profile = self.profiler.get(worker_ctx)
+        if threshold is None or profile is None:
+            return
+        elapsed = timer() - profile.started
+        if elapsed < threshold:
+            return
+
+        policy = self.get_policy(worker_ctx.entrypoint)
+        if not policy.report or not policy.sampled():
+            return
+        if self.is_rate_limited(self.client, DEFAULT_CATEGORY):
+            return
+        fingerprint = ['slow-worker', policy.logger]
+        if self.is_duplicate(hash_fingerprint(fingerprint)):
+            return
+
+        self.build_context(worker_ctx, None, fields=policy.capture)
+        data = {
+            'logger': policy.logger,
+            'level': logging.WARNING,
+            'fingerprint': fingerprint,
+        }
+        profile = self.get_profile(worker_ctx)
+        if profile is not None:
+            data['contexts'] = {'stack_profile': profile}
+
+        self.capture(
+            self.client, 'raven.events.Message',
+            message=SLOW_MESSAGE_TEMPLATE.format(worker_ctx.call_id, elapsed),
+            data=data, stack=False
+        )
+
+    def capture_record(self, worker_ctx, record):
+        """ Report a log record emitted while running a worker; see
+        `SentryHandler`.
+
+        Records go through the same policy, sampling, rate limiting and
+        transport as failed workers. Logged expected exceptions are sent
+        at the `EXPECTED_LEVEL`, or skipped unless
+        `REPORT_EXPECTED_EXCEPTIONS`. An exception logged and then raised
+        is only reported once. The record's message is only formatted
+        once it has been accepted, and messages without an exception are
+        sent with their template and arguments too, so they're grouped by
+        template.
+        """
+        policy = self.get_policy(worker_ctx.entrypoint)
+        if not policy.report or not policy.sampled():
+            return
+
+        exc_info = record.exc_info
+        if exc_info and exc_info[0] is not None:
+            level = record.levelno
+            if self.is_expected_exception(worker_ctx, exc_info):
+                if not policy.report_expected_exceptions:
+                    return
+                level = policy.expected_level
+            client = self.get_client(worker_ctx, exc_info)
+            if self.is_rate_limited(client, ERROR_CATEGORY):
+                return
+            if not self.should_capture(exc_info):
+                return
+            fingerprint = self.fingerprint(exc_info)
+            if self.is_duplicate(fingerprint):
+                return
+            exception = self.snapshot_exception(exc_info)
+            self.build_context(worker_ctx, exc_info, fields=policy.capture)
+            data = {
+                'logger': record.name,
+                'level': level,
+                'exception': exception,
+                'fingerprint': [fingerprint],
+            }
+            self.capture(
+                client, 'nameko_sentry.DetachedExceptionEvent',
+                message=record.getMessage(), data=data
+            )
+            return
+
+        if self.is_rate_limited(self.client, DEFAULT_CATEGORY):
+            return
+        self.build_context(worker_ctx, None, fields=policy.capture)
+        data = {
+            'logger': record.name,
+            'level': record.levelno,
+        }
+        self.capture(
+            self.client, 'raven.events.Message', message=record.msg,
+            params=record.args or (), formatted=record.getMessage(),
+            data=data, stack=False
+        )
+
+    def get_client(self, worker_ctx, exc_info):
+        """ Return the client to send the event for `exc_info` with.
+        """
+        policy = self.get_policy(worker_ctx.entrypoint)
+        return policy.get_client(exc_info, self.client)
+
+    def capture(self, client, event_type, **kwargs):
+        """ Capture an event from the context of the default client, and
+        send it with `client`, in the transport lane for its level.
+        """
+        transport = client.remote.get_transport()
+        data = kwargs['data']
+        with transport.use_lane(get_lane(data['level']), get_category(data)):
+            if self.build_threads:
+                return self.capture_in_thread(client, event_type, **kwargs)
+
+            if client is self.client:
+                return client.capture(event_type, **kwargs)
+
+            if not self.sample_event(client, data):
+                return data['event_id']
+            data = self.client.build_msg(event_type, **kwargs)
+            data['project'] = client.remote.project
+            client.send(**data)
+            return data['event_id']
+
+    def sample_event(self, client, data):
+        """ Give the event `data` its id, and return True if `client`
+        should send it, for events built without `raven.Client.capture`.
+
+        The client's `sample_rate` applies, and the id becomes the
+        `last_event_id` whether or not the event is sent, as with `capture`;
+        but the event is only built if it's sent.
+        """
+        data['event_id'] = event_id = uuid.uuid4().hex
+        self.client._local_state.last_event_id = event_id
+        client._local_state.last_event_id = event_id
+        return client._random.random() < client.sample_rate
+
+    def capture_in_thread(self, client, event_type, **kwargs):
+        """ Build and encode an event in a native thread from
+        `eventlet.tpool`, so the work doesn't block other greenlets, and
+        send it with `client`.
+
+        The client's context, breadcrumbs and transaction are local to the
+        current greenlet, so they're merged into the event data first. At
+        most `BUILD_THREADS` events are built at once; further workers wait
+        for a free slot.
+        """
+        context = self.client.context
+        data = merge_dicts(context.data, kwargs.pop('data', None))
+        crumbs = (
+            self.client.enable_breadcrumbs and context.breadcrumbs.get_buffer()
+        )
+        if crumbs:
+            data.setdefault('breadcrumbs', {'values': crumbs})
+        transaction = self.client.transaction.peek()
+        if transaction:
+            data.setdefault('transaction', transaction)
+
+        if not self.sample_event(client, data):
+            return data['event_id']
+        with self.build_semaphore:
+            event_id, message = tpool.execute(
+                self.build_event, client, event_type, data, kwargs
+            )
+        client.send_encoded(message)
+        return event_id
+
+    def build_event(self, client, event_type, data, kwargs):
+        """ Build and encode an event to send with `client`.
+        """
+        data = self.client.build_msg(event_type, data=data, **kwargs)
+        data['project'] = client.remote.project
+        return data['event_id'], client.encode(data)
+
+    def record_memory_stats(self, event_id, retained_bytes, retained_objects):
+        """ Record the memory still held after capturing an event.
+
+        Only called in `MEMORY_DEBUG` mode; the last `MEMORY_STATS_SIZE`
+        measurements are kept in `memory_stats`.
+        """
+        stats = {
+            'event_id': event_id,
+            'retained_bytes': retained_bytes,
+            'retained_objects': retained_objects,
+        }
+        self.memory_stats.append(stats)
+        log.debug(
+            "Sentry event %(event_id)s retained %(retained_bytes)d bytes "
+            "in %(retained_objects)d objects", stats
+        )
+
+    def capture_remote_reference(self, worker_ctx, exc_info):
+        """ Send a slim reference to a failure that originated downstream.
+
+        The reference carries only the `REMOTE_REFERENCE_FIELDS` of the
+        context, with no stacktrace, user or extra context; the full
+        payload is expected from the originating hop, and the two are
+        correlated by the `root_call_id` tag. The fingerprint groups
+        references by remote exception type rather than by message, which
+        includes the (unique) call id.
+        """
+        _, exc, _ = exc_info
+        message = self.format_message(worker_ctx, exc_info)
+        logger = self.get_policy(worker_ctx.entrypoint).logger
+
+        level = self.get_level(worker_ctx, exc_info)
+        if level is None:
+            return  # nothing to do
 
         data = {
             'logger': logger,
-            'level': level
+            'level': level,
+            'fingerprint': [
+                'remote-error', logger, str(exc.exc_type)
+            ],
         }
 
-        self.client.captureException(exc_info, message=message, data=data)
+        self.capture(
+            self.get_client(worker_ctx, exc_info), 'raven.events.Message',
+            message=message, data=data, stack=False
+        )
+
+
+class SentryHandler(logging.Handler):
+    """ Logging handler reporting records logged by workers with the
+    `SentryReporter` of the current worker.
+
+    Records are sent with the worker's context, like failures of the
+    worker itself; see `SentryReporter.capture_record`. Records logged
+    outside a worker, by loggers in `EXCLUDED_LOGGERS`, or while reporting
+    is disabled are ignored.
+
+    The container logs each failed worker on `nameko.containers`; that
+    failure is reported by `SentryReporter.worker_result` instead, with
+    the entrypoint's policy.
+    """
+    EXCLUDED_LOGGERS = (
+        'raven', 'sentry.errors', 'nameko.containers', __name__
+    )
+
+    def __init__(self, level=logging.ERROR):
+        super(SentryHandler, self).__init__(level)
+
+    def emit(self, record):
+        worker = getattr(current_worker, 'worker', None)
+        if worker is None:
+            return
+        if record.name.startswith(self.EXCLUDED_LOGGERS):
+            return
+        reporter, worker_ctx = worker
+        reporter.capture_record(worker_ctx, record)
+
+
+def read_spool(path, offset=0):
+    """ Yield `(offset, event)` for each line of spool file `path` from
+    byte `offset`, where `offset` is the end of the line.
+
+    `event` is None if the line isn't valid JSON, e.g. if it was only
+    partly written.
+    """
+    with open(path, 'rb') as spool:
+        spool.seek(offset)
+        for line in iter(spool.readline, b''):
+            offset += len(line)
+            try:
+                event = json.loads(line.decode('utf-8'))
+            except ValueError:
+                event = None
+            yield offset, event
+
+
+def event_key(event):
+    """ Return the service, method and exception type of a spooled event.
+    """
+    tags = event.get('tags') or {}
+    values = (event.get('exception') or {}).get('values') or [{}]
+    return (
+        tags.get('service_name'), tags.get('method_name'),
+        values[-1].get('type')
+    )
+
+
+class RateLimiter(object):
+    """ Space calls to `wait` at least `1 / rate` seconds apart.
+    """
+    def __init__(self, rate=None):
+        self.interval = 1.0 / rate if rate else 0
+        self.next_at = 0
+
+    def wait(self):
+        if not self.interval:
+            return
+        now = time.time()
+        self.next_at = max(self.next_at, now)
+        eventlet.sleep(self.next_at - now)
+        self.next_at += self.interval
+
+
+class Replay(object):
+    """ Replay the events in a spool file to `dsn`, or just count them if
+    `dsn` is None.
+
+    Events are sent by up to `concurrency` greenlets, at most `rate` per
+    second, skipping events with an `event_id` already seen. If
+    `offset_path` is given, the offset of the last event before which
+    everything was sent is kept there, and a later replay resumes from it.
+    Sentry ignores events it has already received, so events after a
+    failure that are sent again when resuming are not duplicated.
+    """
+    def __init__(
+        self, path, dsn=None, concurrency=10, rate=None, offset_path=None
+    ):
+        self.path = path
+        self.client = None
+        if dsn is not None:
+            self.client = Client(
+                dsn, transport=HTTPTransport, raise_send_errors=True
+            )
+        self.concurrency = concurrency
+        self.limiter = RateLimiter(rate)
+        self.offset_path = offset_path
+        self.seen = set()
+        self.counts = {}
+        self.stats = dict.fromkeys(
+            ('read', 'sent', 'failed', 'duplicate', 'invalid'), 0
+        )
+
+    def load_offset(self):
+        try:
+            with open(self.offset_path) as offset_file:
+                return int(offset_file.read() or 0)
+        except (IOError, OSError):
+            return 0
+
+    def save_offset(self, offset):
+        with open(self.offset_path, 'w') as offset_file:
+            offset_file.write(str(offset))
+
+    def iter_events(self, offset):
+        for offset, event in read_spool(self.path, offset):
+            if event is None:
+                self.stats['invalid'] += 1
+                yield offset, None
+                continue
+            self.stats['read'] += 1
+            event_id = event.get('event_id')
+            if event_id in self.seen:
+                self.stats['duplicate'] += 1
+                yield offset, None
+                continue
+            self.seen.add(event_id)
+            key = event_key(event)
+            self.counts[key] = self.counts.get(key, 0) + 1
+            if self.client is not None:
+                self.limiter.wait()
+            yield offset, event
+
+    def send(self, item):
+        offset, event = item
+        if event is None or self.client is None:
+            return offset, True
+        event['project'] = self.client.remote.project
+        try:
+            self.client.send(**event)
+        except Exception as exc:
+            log.warning(
+                "Failed to replay event %s: %s", event['event_id'], exc
+            )
+            self.stats['failed'] += 1
+            return offset, False
+        self.stats['sent'] += 1
+        return offset, True
+
+    def run(self):
+        offset = self.load_offset() if self.offset_path else 0
+        all_sent = True
+        pool = GreenPool(self.concurrency)
+        # results are in spool order, so the offset only ever advances
+        # past events that were sent
+        for end, sent in pool.imap(self.send, self.iter_events(offset)):
+            all_sent = all_sent and sent
+            if all_sent:
+                offset = end
+                if self.offset_path:
+                    self.save_offset(offset)
+        return self.stats
+
+
+def format_counts(counts):
+    lines = ['{:>8}  {}'.format('count', 'service.method: exception')]
+    for (service, method, exc_type), count in sorted(
+        counts.items(), key=lambda item: (-item[1], str(item[0]))
+    ):
+        lines.append('{:>8}  {}.{}: {}'.format(
+            count, service, method, exc_type
+        ))
+    return '\n'.join(lines)
+
+
+def main(argv=None, out=sys.stdout):
+    """ Entry point of the `nameko-sentry` command.
+    """
+    parser = argparse.ArgumentParser(prog='nameko-sentry')
+    subparsers = parser.add_subparsers(dest='command')
+    subparsers.required = True
+
+    replay_parser = subparsers.add_parser(
+        'replay', help="replay spooled events to sentry"
+    )
+    replay_parser.add_argument('spool', help="spool file to read")
+    replay_parser.add_argument('--dsn', help="DSN to send events to")
+    replay_parser.add_argument(
+        '--concurrency', type=int, default=10,
+        help="number of events to send at once")
+    replay_parser.add_argument(
+        '--rate', type=float, help="maximum events per second")
+    replay_parser.add_argument(
+        '--offset-file',
+        help="file to keep progress in, to resume an interrupted replay")
+    replay_parser.add_argument(
+        '--dry-run', action='store_true',
+        help="don't send events; print counts per service, method and "
+             "exception type")
+
+    options = parser.parse_args(argv)
+    if not options.dry_run and not options.dsn:
+        parser.error("--dsn is required unless --dry-run is given")
+
+    eventlet.monkey_patch()
+
+    replay = Replay(
+        options.spool,
+        dsn=None if options.dry_run else options.dsn,
+        concurrency=options.concurrency,
+        rate=options.rate,
+        offset_path=None if options.dry_run else options.offset_file,
+    )
+    stats = replay.run()
+
+    out.write(
+        "{read} events read, {sent} sent, {failed} failed, "
+        "{duplicate} duplicate, {invalid} invalid\n".format(**stats)
+    )
+    if options.dry_run:
+        out.write(format_counts(replay.counts) + '\n')
+    return 1 if stats['failed'] else 0
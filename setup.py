@@ -8,10 +8,19 @@ setup(
     author='Matt Bennett',
     author_email='matt@bennett.name',
     url='http://github.com/mattbennett/nameko-sentry',
-    py_modules=['nameko_sentry'],
+    py_modules=['nameko_sentry', 'pytest_nameko_sentry'],
+    entry_points={
+        'console_scripts': [
+            'nameko-sentry=nameko_sentry:main',
+        ],
+        'pytest11': [
+            'pytest_nameko_sentry=pytest_nameko_sentry',
+        ],
+    },
     install_requires=[
         "nameko>=2.5.1",
-        "raven>=3.0.0"
+        "raven>=3.0.0",
+        "wrapt>=1.0.0",
     ],
     extras_require={
         'dev': [